@@ -0,0 +1,85 @@
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from chats import membership, presence
+from chats.serializers import MessageSerializer
+from core import fastjson
+from core.channel_layers import group_send_many
+
+
+def encode_message_frame(data):
+    """
+    Encodes a serialized message into the websocket frame sent to clients,
+    once per message, so consumers can forward it without re-encoding.
+    """
+    return fastjson.dumps_text({"message": data})
+
+
+def get_notified_users(chat_id, sender_id):
+    """
+    Returns the ids of the online members of the chat, other than the
+    sender, who do not have it open and so need a notification instead.
+    """
+    active_users_in_chat = presence.get_active_users_in_chat(chat_id)
+    users_not_active_in_chat = (
+        membership.get_member_ids(chat_id) - active_users_in_chat - {str(sender_id)}
+    )
+    return presence.get_online_users(users_not_active_in_chat)
+
+
+@database_sync_to_async
+def get_message_recipients(message):
+    """
+    Returns the encoded message frame and the ids of the users to notify.
+    """
+    frame = encode_message_frame(MessageSerializer(message).data)
+    return frame, get_notified_users(message.chat_id, message.sender_id)
+
+
+@database_sync_to_async
+def get_batch_recipients(messages):
+    """
+    Returns one frame carrying all the messages, which were sent together to
+    one chat, and the ids of the users to notify.
+    """
+    frame = fastjson.dumps_text(
+        {"messages": MessageSerializer(messages, many=True).data}
+    )
+    return frame, get_notified_users(messages[0].chat_id, messages[0].sender_id)
+
+
+async def send_frame(channel_layer, chat_id, frame, user_ids):
+    await channel_layer.group_send(
+        "chat_%s" % chat_id,
+        {"type": "chat_message", "frame": frame},
+    )
+    await group_send_many(
+        channel_layer,
+        ["user_%s" % user_id for user_id in user_ids],
+        {"type": "notify_message", "frame": frame},
+    )
+
+
+async def dispatch_message(message, channel_layer=None):
+    """
+    Sends a new message to its chat room, and a notification to the online
+    members who are elsewhere in the app.
+    """
+    channel_layer = channel_layer or get_channel_layer()
+    frame, user_ids = await get_message_recipients(message)
+    await send_frame(channel_layer, message.chat_id, frame, user_ids)
+
+
+async def dispatch_messages(messages, channel_layer=None):
+    """
+    Sends messages created together (see `Message.bulk_send`) as a single
+    event per chat instead of one per message.
+    """
+    channel_layer = channel_layer or get_channel_layer()
+    messages_by_chat = {}
+    for message in messages:
+        messages_by_chat.setdefault(message.chat_id, []).append(message)
+
+    for chat_id, chat_messages in messages_by_chat.items():
+        frame, user_ids = await get_batch_recipients(chat_messages)
+        await send_frame(channel_layer, chat_id, frame, user_ids)
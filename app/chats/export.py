@@ -0,0 +1,77 @@
+"""
+NDJSON export of a chat's full history, one message per line, oldest first.
+
+Messages are read from a server-side cursor in chunks of `CHUNK_SIZE`, and
+each chunk's media and senders' profile cards are loaded in one batch, so
+memory stays flat however long the chat is.
+"""
+
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from core import fastjson
+from users import profile_cards
+
+from .models import Message
+
+CHUNK_SIZE = 500
+
+
+def export_message(message, cards):
+    card = cards.get(str(message.sender_id))
+    # Same fields as `MessageSerializer.sender_info`: no phone numbers.
+    sender = card and {
+        "id": card["id"],
+        "name": card["name"],
+        "profile_picture": card["profile_picture"],
+    }
+    return {
+        "id": message.id,
+        "created_at": message.created_at,
+        "updated_at": message.updated_at,
+        "type": message.type,
+        "text": message.text,
+        "sender": sender,
+        "reply_to": message.reply_to_id,
+        "is_forwarded": message.is_forwarded,
+        "media": [
+            {"id": media.id, "type": media.type, "url": media.file.url}
+            for media in message.media.all()
+        ],
+    }
+
+
+def render_next_chunk(messages):
+    """
+    Reads the next chunk of messages from the iterator and renders it as
+    NDJSON lines, or returns None when there are no messages left.
+    """
+    chunk = list(islice(messages, CHUNK_SIZE))
+    if not chunk:
+        return None
+
+    cards = profile_cards.get_many(message.sender_id for message in chunk)
+    return b"".join(
+        fastjson.dumps(export_message(message, cards)) + b"\n" for message in chunk
+    )
+
+
+async def stream_chat_export(chat):
+    """
+    Yields the chat's visible messages as NDJSON lines, one chunk at a time.
+    Chunks are read and rendered off the event loop, so under ASGI only
+    one is held in memory.
+    """
+    messages = (
+        Message.objects.filter(chat=chat, is_deleted=False)
+        .order_by("created_at", "id")
+        .prefetch_related("media")
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+
+    while True:
+        body = await sync_to_async(render_next_chunk)(messages)
+        if body is None:
+            break
+        yield body
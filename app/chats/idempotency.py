@@ -0,0 +1,75 @@
+"""
+Deduplication of retried message sends by client message id.
+
+The id of every message sent with a client message id is kept in Redis for
+`TTL` seconds under `client_message:<sender_id>:<chat_id>:<client_message_id>`,
+so a retry is answered without querying Postgres. Retries that miss Redis
+are still caught by the unique constraint on the message.
+"""
+
+from django.db import IntegrityError, transaction
+
+from .models import Message
+from .utils import redis_client
+
+KEY = "client_message:%s:%s:%s"
+
+TTL = 60 * 60 * 24
+
+
+def get_duplicate(sender_id, chat_id, client_message_id):
+    """
+    Returns the message the sender already sent to the chat with this client
+    message id, if Redis knows about it.
+    """
+    if not client_message_id:
+        return None
+
+    try:
+        message_id = redis_client.get(KEY % (sender_id, chat_id, client_message_id))
+    except Exception as e:
+        print(f"Error reading client message id from redis: {e}")
+        return None
+
+    if message_id is None:
+        return None
+    return Message.objects.filter(id=message_id.decode()).first()
+
+
+def remember(message):
+    try:
+        redis_client.set(
+            KEY % (message.sender_id, message.chat_id, message.client_message_id),
+            str(message.id),
+            ex=TTL,
+        )
+    except Exception as e:
+        print(f"Error writing client message id to redis: {e}")
+
+
+def save_message(serializer, **kwargs):
+    """
+    Saves the message of a validated serializer, unless the sender already
+    sent one to the chat with the same client message id. Returns the
+    message and whether it was created.
+    """
+    data = {**serializer.validated_data, **kwargs}
+    sender_id = data["sender"].id
+    chat_id = data["chat"].id if "chat" in data else data["chat_id"]
+    client_message_id = data.get("client_message_id")
+
+    message = get_duplicate(sender_id, chat_id, client_message_id)
+    if message:
+        return message, False
+
+    try:
+        # The message and its outbox entry are committed together.
+        with transaction.atomic():
+            return serializer.save(**kwargs), True
+    except IntegrityError:
+        if not client_message_id:
+            raise
+        message = Message.objects.get(
+            sender_id=sender_id, chat_id=chat_id, client_message_id=client_message_id
+        )
+        return message, False
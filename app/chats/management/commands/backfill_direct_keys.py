@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from chats.models import Chat
+
+
+class Command(BaseCommand):
+    help = (
+        "Sets the direct_key of existing individual chats. When a pair of users "
+        "has more than one chat, only the oldest one gets the key."
+    )
+
+    def handle(self, *args, **options):
+        chats = (
+            Chat.objects.filter(type=Chat.ChatTypes.individual, direct_key__isnull=True)
+            .annotate(member_count=Count("members"))
+            .filter(member_count=2)
+            .order_by("created_at")
+        )
+
+        updated = skipped = 0
+        for chat in chats.iterator():
+            user_ids = chat.members.values_list("user_id", flat=True)
+            direct_key = Chat.get_direct_key(*user_ids)
+            if Chat.objects.filter(direct_key=direct_key).exists():
+                skipped += 1
+                continue
+            chat.direct_key = direct_key
+            chat.save(update_fields=["direct_key", "updated_at"])
+            updated += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Set {updated} direct chat keys, skipped {skipped} duplicate chats"
+            )
+        )
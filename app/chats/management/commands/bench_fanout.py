@@ -0,0 +1,52 @@
+import asyncio
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from channels.layers import get_channel_layer
+
+from core.channel_layers import group_send_many
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares notifying many user groups one group_send at a time with "
+        "group_send_many. Needs the Redis channel layer to be reachable."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=500)
+        parser.add_argument("--rounds", type=int, default=10)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options["users"], options["rounds"]))
+
+    async def run(self, users, rounds):
+        channel_layer = get_channel_layer()
+        groups = ["bench_user_%s" % uuid.uuid4().hex for _ in range(users)]
+        channels = [await channel_layer.new_channel() for _ in groups]
+        for group, channel in zip(groups, channels):
+            await channel_layer.group_add(group, channel)
+
+        message = {"type": "notify_message", "message": {"text": "benchmark"}}
+
+        async def send_in_loop():
+            for group in groups:
+                await channel_layer.group_send(group, message)
+
+        async def send_in_bulk():
+            await group_send_many(channel_layer, groups, message)
+
+        try:
+            for name, send in (("loop", send_in_loop), ("bulk", send_in_bulk)):
+                started = time.perf_counter()
+                for _ in range(rounds):
+                    await send()
+                elapsed = (time.perf_counter() - started) / rounds
+                self.stdout.write(
+                    f"{name}: {elapsed * 1000:.2f} ms per fan-out to {users} users"
+                )
+        finally:
+            for group, channel in zip(groups, channels):
+                await channel_layer.group_discard(group, channel)
@@ -0,0 +1,47 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rest_framework.renderers import JSONRenderer
+
+from chats.models import InboxEntry, Message
+from chats.serializers import InboxSerializer, MessageSerializer
+from core import fastjson
+from core.renderers import FastJSONRenderer
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares DRF's JSONRenderer and the stdlib json module with the fast "
+        "JSON layer on serialized messages and inbox entries from the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=50)
+        parser.add_argument("--number", type=int, default=200)
+
+    def handle(self, *args, **options):
+        size, number = options["size"], options["number"]
+        messages = Message.objects.select_related("chat").order_by("-created_at")
+        entries = InboxEntry.objects.select_related("chat", "last_message")
+
+        payloads = {
+            "messages": MessageSerializer(messages[:size], many=True).data,
+            "inbox": InboxSerializer(entries[:size], many=True).data,
+        }
+        if not all(payloads.values()):
+            raise CommandError("Seed some chats and messages before benchmarking.")
+
+        for name, data in payloads.items():
+            encoded = fastjson.dumps(data)
+            results = {
+                "JSONRenderer": lambda: JSONRenderer().render(data),
+                "FastJSONRenderer": lambda: FastJSONRenderer().render(data),
+                "json.loads": lambda: json.loads(encoded),
+                "fastjson.loads": lambda: fastjson.loads(encoded),
+            }
+            self.stdout.write(f"{name} ({len(data)} items, {len(encoded)} bytes)")
+            for label, func in results.items():
+                elapsed = timeit.timeit(func, number=number) / number
+                self.stdout.write(f"  {label}: {elapsed * 1e6:.1f} us")
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from chats.models import ChatParticipant, MessageStatus
+
+
+class Command(BaseCommand):
+    help = (
+        "Folds per-message MessageStatus rows into the read and delivered "
+        "watermarks of each chat participant."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete the MessageStatus rows once they have been compacted.",
+        )
+
+    def handle(self, *args, **options):
+        participants = ChatParticipant.objects.filter(
+            user__message_info__message__chat=F("chat")
+        ).distinct()
+
+        compacted = 0
+        for participant in participants.iterator():
+            statuses = MessageStatus.objects.filter(
+                user_id=participant.user_id, message__chat_id=participant.chat_id
+            ).select_related("message")
+
+            with transaction.atomic():
+                for status, mark in (
+                    (MessageStatus.Status.delivered, participant.mark_delivered),
+                    (MessageStatus.Status.read, participant.mark_read),
+                ):
+                    latest = (
+                        statuses.filter(status=status)
+                        .order_by("-message__created_at")
+                        .first()
+                    )
+                    if latest:
+                        mark(latest.message)
+
+                if options["delete"]:
+                    statuses.delete()
+            compacted += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Compacted message statuses of {compacted} participants"
+            )
+        )
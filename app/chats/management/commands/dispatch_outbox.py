@@ -0,0 +1,121 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+
+from channels.layers import get_channel_layer
+
+from chats.dispatch import dispatch_message, dispatch_messages
+from chats.models import MessageOutbox
+
+
+class Command(BaseCommand):
+    help = "Drains the message outbox and fans new messages out to websockets."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=0.5,
+            help="Seconds to wait when the outbox is empty.",
+        )
+        parser.add_argument(
+            "--lease",
+            type=int,
+            default=30,
+            help="Seconds a claimed entry is hidden from other dispatchers.",
+        )
+        parser.add_argument("--max-attempts", type=int, default=10)
+        parser.add_argument(
+            "--once", action="store_true", help="Drain the outbox once and exit."
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(**options))
+
+    async def run(self, batch_size, poll_interval, lease, max_attempts, once, **kwargs):
+        channel_layer = get_channel_layer()
+        await self.discard_exhausted(max_attempts)
+        while True:
+            entries = await sync_to_async(MessageOutbox.claim_batch)(
+                batch_size, lease, max_attempts
+            )
+            if entries:
+                if not await self.dispatch_batch(entries, channel_layer):
+                    await self.discard_exhausted(max_attempts)
+            elif once:
+                return
+            else:
+                await asyncio.sleep(poll_interval)
+
+    async def discard_exhausted(self, max_attempts):
+        for entry in await sync_to_async(MessageOutbox.discard_exhausted)(max_attempts):
+            self.stderr.write(
+                f"Giving up on message {entry.message_id} after {entry.attempts} "
+                f"attempts: {entry.last_error}"
+            )
+
+    def group_entries(self, entries):
+        """
+        Groups the entries of each bulk send by chat, so each group goes out
+        as one frame. Other entries are sent one by one.
+        """
+        groups = {}
+        for entry in entries:
+            if entry.batch_id:
+                key = (entry.batch_id, entry.message.chat_id)
+            else:
+                key = entry.id
+            groups.setdefault(key, []).append(entry)
+        return list(groups.values())
+
+    async def dispatch_group(self, group, channel_layer):
+        if len(group) == 1 and not group[0].batch_id:
+            await dispatch_message(group[0].message, channel_layer)
+        else:
+            await dispatch_messages([entry.message for entry in group], channel_layer)
+
+    async def dispatch_chat(self, groups, channel_layer):
+        """
+        Sends the groups of one chat one after the other, in id order. When a
+        group fails, it and the groups after it are left for a retry, so
+        they still go out in order. Returns the ids of the sent entries,
+        the failed entries and the error.
+
+        Later entries of the chat are not claimed while a failed one waits
+        for its retry, see `MessageOutbox.claim_batch`.
+        """
+        sent = []
+        for index, group in enumerate(groups):
+            try:
+                await self.dispatch_group(group, channel_layer)
+            except Exception as e:
+                return sent, [entry for group in groups[index:] for entry in group], e
+            sent += [entry.id for entry in group]
+        return sent, [], None
+
+    async def dispatch_batch(self, entries, channel_layer):
+        """
+        Sends the claimed entries and deletes the sent ones. Returns whether
+        all of them were sent.
+        """
+        # Chats are sent concurrently, the groups of each chat in order.
+        chats = {}
+        for group in self.group_entries(entries):
+            chats.setdefault(group[0].message.chat_id, []).append(group)
+        results = await asyncio.gather(
+            *(self.dispatch_chat(groups, channel_layer) for groups in chats.values())
+        )
+
+        sent = []
+        for chat_sent, failed, error in results:
+            sent += chat_sent
+            for entry in failed:
+                self.stderr.write(
+                    f"Error dispatching message {entry.message_id}: {error}"
+                )
+                await sync_to_async(entry.retry_later)(error)
+
+        await sync_to_async(MessageOutbox.objects.filter(id__in=sent).delete)()
+        return len(sent) == len(entries)
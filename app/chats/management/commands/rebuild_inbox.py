@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from chats.models import ChatParticipant, InboxEntry
+
+
+class Command(BaseCommand):
+    help = "Creates the inbox entries of chat participants that do not have one yet."
+
+    def handle(self, *args, **options):
+        participants = (
+            ChatParticipant.objects.filter(inbox_entry__isnull=True)
+            .select_related("chat")
+            .order_by("created_at")
+        )
+
+        created = 0
+        for participant in participants.iterator():
+            InboxEntry.create_for_participant(participant)
+            created += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Created {created} inbox entries"))
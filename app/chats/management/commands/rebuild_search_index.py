@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats import search
+from chats.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Indexes the text of existing messages for full-text search: fills "
+        "search_vector on PostgreSQL, or the FTS5 table on SQLite."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of messages indexed per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        search.create_search_index()
+
+        messages = Message.objects.only("id", "chat_id", "text", "is_deleted")
+        batch = []
+        indexed = 0
+        for message in messages.order_by("id").iterator():
+            batch.append(message)
+            if len(batch) == options["batch_size"]:
+                indexed += self.index(batch)
+                batch = []
+        indexed += self.index(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} messages"))
+
+    def index(self, messages):
+        if not messages:
+            return 0
+        with transaction.atomic():
+            search.index_messages(messages)
+        return len(messages)
@@ -0,0 +1,202 @@
+"""
+Chat membership index kept in Redis sets, in both directions:
+
+- `membership:user:<user_id>` holds the ids of the chats the user is in.
+- `membership:chat:<chat_id>` holds the ids of the chat's members.
+
+Only participants who have not left are members. Sets are loaded lazily
+from the database on first use and dropped by `invalidate` whenever a
+participant joins, leaves or is removed (see `chats.signals`), so the next
+read reloads them. `invalidate` also bumps a per-set generation, and a fill
+is only written if the generation has not moved since the set was loaded,
+so a load that raced with a membership change cannot cache stale ids. Every
+set also holds an empty placeholder member, so a
+user without chats is still cached.
+
+Redis errors fall back to the database, so membership checks keep working
+when Redis is down.
+"""
+
+import uuid
+
+from channels.db import database_sync_to_async
+
+from .models import ChatParticipant
+from .utils import async_redis_client, redis_client
+
+USER_KEY = "membership:user:%s"
+CHAT_KEY = "membership:chat:%s"
+GENERATION_KEY = "membership:generation:%s"
+
+# Bounds how long a set can outlive a missed invalidation.
+TTL = 60 * 60
+
+PLACEHOLDER = ""
+
+# Fills a set only if its generation is still the one read before loading
+# it from the database, so a fill never brings back a set that an
+# `invalidate` dropped in the meantime.
+FILL_SCRIPT = """
+    if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+        return 0
+    end
+    for i = 3, #ARGV do
+        redis.call('SADD', KEYS[1], ARGV[i])
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+"""
+
+
+def _load_chat_ids(user_id):
+    return {
+        str(chat_id)
+        for chat_id in ChatParticipant.objects.filter(
+            user_id=user_id, left_at__isnull=True
+        ).values_list("chat_id", flat=True)
+    }
+
+
+def _load_member_ids(chat_id):
+    return {
+        str(user_id)
+        for user_id in ChatParticipant.objects.filter(
+            chat_id=chat_id, left_at__isnull=True
+        ).values_list("user_id", flat=True)
+    }
+
+
+def _decode(members):
+    return {member.decode() for member in members} - {PLACEHOLDER}
+
+
+def _fill_args(key, generation, ids):
+    generation = generation.decode() if generation else "0"
+    return [
+        FILL_SCRIPT,
+        2,
+        key,
+        GENERATION_KEY % key,
+        generation,
+        TTL,
+        PLACEHOLDER,
+        *ids,
+    ]
+
+
+def _normalize(chat_id):
+    try:
+        return str(uuid.UUID(str(chat_id)))
+    except ValueError:
+        return None
+
+
+def _read(pipeline, key, member=None):
+    pipeline.exists(key)
+    if member is None:
+        pipeline.smembers(key)
+    else:
+        pipeline.sismember(key, member)
+    pipeline.get(GENERATION_KEY % key)
+
+
+def _get(key, load):
+    try:
+        pipeline = redis_client.pipeline(transaction=False)
+        _read(pipeline, key)
+        exists, members, generation = pipeline.execute()
+        if exists:
+            return _decode(members)
+    except Exception as e:
+        print(f"Error reading membership from redis: {e}")
+        return load()
+
+    ids = load()
+    try:
+        redis_client.eval(*_fill_args(key, generation, ids))
+    except Exception as e:
+        print(f"Error writing membership to redis: {e}")
+    return ids
+
+
+def get_chat_ids(user_id):
+    """
+    Returns the ids of the chats the user is a member of.
+    """
+    return _get(USER_KEY % user_id, lambda: _load_chat_ids(user_id))
+
+
+def get_member_ids(chat_id):
+    """
+    Returns the ids of the chat's members.
+    """
+    return _get(CHAT_KEY % chat_id, lambda: _load_member_ids(chat_id))
+
+
+def is_member(chat_id, user_id):
+    """
+    Returns whether the user is a member of the chat, answered from the
+    user's chat set with a single SISMEMBER once it is cached.
+    """
+    chat_id = _normalize(chat_id)
+    if chat_id is None:
+        return False
+
+    key = USER_KEY % user_id
+    try:
+        pipeline = redis_client.pipeline(transaction=False)
+        _read(pipeline, key, chat_id)
+        exists, found, _ = pipeline.execute()
+    except Exception as e:
+        print(f"Error reading membership from redis: {e}")
+        return chat_id in _load_chat_ids(user_id)
+
+    if exists:
+        return bool(found)
+    return chat_id in get_chat_ids(user_id)
+
+
+async def ais_member(chat_id, user_id):
+    """
+    Async version of `is_member` for websocket consumers.
+    """
+    chat_id = _normalize(chat_id)
+    if chat_id is None:
+        return False
+
+    key = USER_KEY % user_id
+    load = database_sync_to_async(_load_chat_ids)
+    try:
+        pipeline = async_redis_client.pipeline(transaction=False)
+        _read(pipeline, key, chat_id)
+        exists, found, generation = await pipeline.execute()
+    except Exception as e:
+        print(f"Error reading membership from redis: {e}")
+        return chat_id in await load(user_id)
+
+    if exists:
+        return bool(found)
+
+    chat_ids = await load(user_id)
+    try:
+        await async_redis_client.eval(*_fill_args(key, generation, chat_ids))
+    except Exception as e:
+        print(f"Error writing membership to redis: {e}")
+    return chat_id in chat_ids
+
+
+def invalidate(chat_id, user_id):
+    """
+    Drops the cached sets that a change to the user's membership of the chat
+    makes stale, and bumps their generations so fills that loaded before
+    the change are discarded.
+    """
+    try:
+        pipeline = redis_client.pipeline(transaction=False)
+        for key in (USER_KEY % user_id, CHAT_KEY % chat_id):
+            pipeline.incr(GENERATION_KEY % key)
+            pipeline.expire(GENERATION_KEY % key, TTL)
+            pipeline.delete(key)
+        pipeline.execute()
+    except Exception as e:
+        print(f"Error deleting membership from redis: {e}")
@@ -1,7 +1,7 @@
 from rest_framework.permissions import BasePermission
 
 from core.permissions import IsAuthenticationAndRegistered
-from .models import Chat
+from . import membership
 
 
 class IsChatMember(IsAuthenticationAndRegistered, BasePermission):
@@ -12,4 +12,4 @@ class IsChatMember(IsAuthenticationAndRegistered, BasePermission):
             return False
 
         chat_id = request.data.get("chat")
-        return Chat.objects.filter(id=chat_id, members__user=request.user).exists()
+        return membership.is_member(chat_id, request.user.id)
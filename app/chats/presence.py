@@ -0,0 +1,113 @@
+"""
+Presence registry kept in Redis sorted sets scored by expiry time:
+
+- `presence:online` holds every user with a live notifications socket.
+- `presence:chat:<chat_id>` holds the users with that chat open.
+
+Expired members are trimmed on write and on read, so lookups never scan the
+keyspace and stay O(log n) in the size of the set.
+
+Websocket consumers write through the async functions (prefixed with `a`)
+and `PresenceHeartbeat`, which run on the event loop instead of the sync
+thread pool.
+"""
+
+import time
+
+from .utils import async_redis_client, redis_client
+
+ONLINE_KEY = "presence:online"
+CHAT_KEY = "presence:chat:%s"
+
+ONLINE_TTL = 30
+CHAT_TTL = 20
+
+
+async def _atouch(key, user_id, ttl):
+    now = time.time()
+    pipeline = async_redis_client.pipeline(transaction=False)
+    pipeline.zadd(key, {str(user_id): now + ttl})
+    pipeline.zremrangebyscore(key, "-inf", now)
+    pipeline.expire(key, ttl)
+    await pipeline.execute()
+
+
+def _live_members(key):
+    now = time.time()
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.zremrangebyscore(key, "-inf", now)
+    pipeline.zrangebyscore(key, now, "+inf")
+    _, members = pipeline.execute()
+    return {member.decode() for member in members}
+
+
+async def amark_inactive_in_chat(chat_id, user_id):
+    await async_redis_client.zrem(CHAT_KEY % chat_id, str(user_id))
+
+
+def get_active_users_in_chat(chat_id):
+    """
+    Returns the ids of the users who currently have the chat open.
+    """
+    return _live_members(CHAT_KEY % chat_id)
+
+
+def get_online_users(user_ids):
+    """
+    Returns which of the given user ids are online, in one O(len(user_ids))
+    lookup instead of loading the whole online set.
+    """
+    user_ids = [str(user_id) for user_id in user_ids]
+    if not user_ids:
+        return set()
+
+    now = time.time()
+    scores = redis_client.zmscore(ONLINE_KEY, user_ids)
+    return {
+        user_id
+        for user_id, expires_at in zip(user_ids, scores)
+        if expires_at is not None and expires_at > now
+    }
+
+
+async def aget_online_users(user_ids):
+    user_ids = [str(user_id) for user_id in user_ids]
+    if not user_ids:
+        return set()
+
+    now = time.time()
+    scores = await async_redis_client.zmscore(ONLINE_KEY, user_ids)
+    return {
+        user_id
+        for user_id, expires_at in zip(user_ids, scores)
+        if expires_at is not None and expires_at > now
+    }
+
+
+class PresenceHeartbeat:
+    """
+    Presence writes of one websocket connection. Pings are coalesced: an
+    entry is only rewritten once less than half of its TTL is left, so most
+    pings do not touch Redis at all.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._refresh_at = {}
+
+    async def _touch(self, key, ttl):
+        now = time.monotonic()
+        if self._refresh_at.get(key, 0) > now:
+            return
+        await _atouch(key, self.user_id, ttl)
+        self._refresh_at[key] = now + ttl / 2
+
+    async def online(self):
+        await self._touch(ONLINE_KEY, ONLINE_TTL)
+
+    async def active_in_chat(self, chat_id):
+        await self._touch(CHAT_KEY % chat_id, CHAT_TTL)
+
+    async def inactive_in_chat(self, chat_id):
+        self._refresh_at.pop(CHAT_KEY % chat_id, None)
+        await amark_inactive_in_chat(chat_id, self.user_id)
@@ -0,0 +1,119 @@
+"""
+Read receipts sent over websockets, batched per connection.
+
+Reads are collected for `FLUSH_INTERVAL` seconds and then flushed: the
+user's read watermark in each chat is moved once, to the newest message
+read, and a single receipt is broadcast to the chat. A client scrolling
+through hundreds of messages causes one write per chat, not one per
+message.
+"""
+
+import asyncio
+import uuid
+
+from channels.db import database_sync_to_async
+from django.utils import timezone
+
+from core import fastjson
+
+from .models import ChatParticipant, Message
+
+FLUSH_INTERVAL = 1
+
+
+@database_sync_to_async
+def advance_read_cursor(chat_id, user_id, message_ids):
+    """
+    Moves the user's read watermark in the chat to the newest of the given
+    messages. Returns that message, or None if the watermark did not move.
+    """
+    participant = (
+        ChatParticipant.objects.select_related(
+            "last_read_message", "last_delivered_message"
+        )
+        .filter(chat_id=chat_id, user_id=user_id, left_at__isnull=True)
+        .first()
+    )
+    if participant is None:
+        return None
+
+    message = (
+        Message.objects.filter(chat_id=chat_id, id__in=message_ids)
+        .order_by("-created_at", "-id")
+        .first()
+    )
+    if message is None:
+        return None
+
+    last_read_message_id = participant.last_read_message_id
+    participant.mark_read(message)
+    if participant.last_read_message_id == last_read_message_id:
+        return None
+    return message
+
+
+def encode_receipt_frame(chat_id, user_id, message_id):
+    return fastjson.dumps_text(
+        {
+            "type": "read_receipt",
+            "chat_id": str(chat_id),
+            "user_id": str(user_id),
+            "message_id": str(message_id),
+            "read_at": timezone.now(),
+        }
+    )
+
+
+class ReadReceiptBuffer:
+    """
+    Read receipts of one websocket connection waiting to be flushed.
+    """
+
+    def __init__(self, channel_layer, user_id):
+        self.channel_layer = channel_layer
+        self.user_id = user_id
+        self._pending = {}
+        self._flush_task = None
+
+    async def read(self, chat_id, message_id):
+        try:
+            message_id = uuid.UUID(str(message_id))
+        except ValueError:
+            return
+
+        self._pending.setdefault(chat_id, set()).add(message_id)
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(FLUSH_INTERVAL)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        for chat_id, message_ids in pending.items():
+            try:
+                message = await advance_read_cursor(chat_id, self.user_id, message_ids)
+            except Exception as e:
+                print(f"Error saving read receipts: {e}")
+                continue
+
+            if message is None:
+                continue
+            await self.channel_layer.group_send(
+                "chat_%s" % chat_id,
+                {
+                    "type": "read_receipt",
+                    "frame": encode_receipt_frame(chat_id, self.user_id, message.id),
+                },
+            )
+
+    async def close(self):
+        """
+        Flushes what is pending right away, for when the connection closes.
+        """
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
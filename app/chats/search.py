@@ -0,0 +1,203 @@
+"""
+Full-text search over messages.
+
+On PostgreSQL, `Message.search_vector` holds a stored tsvector of the text,
+backed by a GIN index. Results are ranked with ts_rank and highlighted
+with ts_headline. SQLite has none of these, so there messages are indexed
+in an FTS5 virtual table instead, ranked with bm25() and highlighted with
+snippet().
+
+Snippets are HTML-escaped, so only the `<mark>` tags around the matching
+words are markup.
+
+The index is created after migrate by `create_search_index`, and filled
+for existing messages by the `rebuild_search_index` command. It is kept
+up to date on write by `index_messages`, `unindex_messages` and
+`unindex_chat`: see `chats.signals`, and `Message.bulk_send` for inserts
+that skip signals.
+"""
+
+import html
+import re
+import uuid
+
+from django.contrib.postgres.search import (
+    SearchHeadline,
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+)
+from django.db import connection, connections
+from django.db.models import F, Q
+
+from .models import Message
+
+CONFIG = "english"
+GIN_INDEX = "chats_message_search_gin"
+FTS_TABLE = "chats_message_fts"
+START_SEL = "<mark>"
+STOP_SEL = "</mark>"
+# The database highlights with these private use characters instead of the
+# tags, so the text around them can be escaped before the tags go in.
+START_SENTINEL = "\ue000"
+STOP_SENTINEL = "\ue001"
+SNIPPET_TOKENS = 12
+
+
+def create_search_index(using="default"):
+    """
+    Creates the GIN index on PostgreSQL, or the FTS5 table on SQLite.
+    """
+    db = connections[using]
+    with db.cursor() as cursor:
+        if db.vendor == "postgresql":
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS %s ON %s USING gin (search_vector)"
+                % (GIN_INDEX, Message._meta.db_table)
+            )
+        elif db.vendor == "sqlite":
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s "
+                "USING fts5(text, message_id UNINDEXED, chat_id UNINDEXED)" % FTS_TABLE
+            )
+
+
+def unindex_messages(message_ids):
+    if connection.vendor == "sqlite" and message_ids:
+        placeholders = ", ".join(["%s"] * len(message_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM %s WHERE message_id IN (%s)" % (FTS_TABLE, placeholders),
+                [uuid.UUID(str(message_id)).hex for message_id in message_ids],
+            )
+
+
+def unindex_chat(chat_id):
+    """
+    Drops the FTS5 rows of a deleted chat, whose messages were deleted in
+    bulk without `unindex_messages`.
+    """
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM %s WHERE chat_id = %%s" % FTS_TABLE,
+                [uuid.UUID(str(chat_id)).hex],
+            )
+
+
+def index_messages(messages):
+    """
+    Indexes the current text of the given messages.
+    """
+    if connection.vendor == "postgresql":
+        Message.objects.filter(id__in=[message.id for message in messages]).update(
+            search_vector=SearchVector("text", config=CONFIG)
+        )
+    elif connection.vendor == "sqlite":
+        unindex_messages([message.id for message in messages])
+        rows = [
+            (message.text, message.id.hex, uuid.UUID(str(message.chat_id)).hex)
+            for message in messages
+            if message.text and not message.is_deleted
+        ]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO %s (text, message_id, chat_id) VALUES (%%s, %%s, %%s)"
+                % FTS_TABLE,
+                rows,
+            )
+
+
+def search_postgresql(query, chat_ids, before, limit):
+    search_query = SearchQuery(query, config=CONFIG, search_type="websearch")
+    messages = (
+        Message.objects.filter(
+            chat_id__in=chat_ids, is_deleted=False, search_vector=search_query
+        )
+        .annotate(rank=SearchRank(F("search_vector"), search_query))
+        .order_by("-rank", "-id")
+    )
+    if before:
+        rank, pk = before
+        messages = messages.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+
+    return messages.select_related("chat").annotate(
+        snippet=SearchHeadline(
+            "text",
+            search_query,
+            config=CONFIG,
+            start_sel=START_SENTINEL,
+            stop_sel=STOP_SENTINEL,
+            max_words=SNIPPET_TOKENS,
+            min_words=SNIPPET_TOKENS // 2,
+        )
+    )[:limit]
+
+
+def search_sqlite(query, chat_ids, before, limit):
+    # Quote every word, so user input is never read as FTS5 syntax.
+    terms = " ".join('"%s"' % word for word in re.findall(r"\w+", query))
+    if not terms or not chat_ids:
+        return []
+
+    sql = (
+        "SELECT message_id, -bm25({table}) AS rank, "
+        "snippet({table}, 0, %s, %s, '…', %s) "
+        "FROM {table} WHERE {table} MATCH %s AND chat_id IN ({chats})"
+    ).format(table=FTS_TABLE, chats=", ".join(["%s"] * len(chat_ids)))
+    params = [START_SENTINEL, STOP_SENTINEL, SNIPPET_TOKENS, terms]
+    params += [uuid.UUID(str(chat_id)).hex for chat_id in chat_ids]
+    if before:
+        rank, pk = before
+        pk = uuid.UUID(pk).hex
+        sql += (
+            " AND (-bm25({table}) < %s OR (-bm25({table}) = %s AND message_id < %s))"
+        ).format(table=FTS_TABLE)
+        params += [rank, rank, pk]
+    sql += " ORDER BY rank DESC, message_id DESC LIMIT %s"
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    messages = Message.objects.select_related("chat").in_bulk(
+        [uuid.UUID(message_id) for message_id, _, _ in rows]
+    )
+    results = []
+    for message_id, rank, snippet in rows:
+        message = messages.get(uuid.UUID(message_id))
+        if message is None or message.is_deleted:
+            continue
+        message.rank = rank
+        message.snippet = snippet
+        results.append(message)
+    return results
+
+
+def highlight(snippet):
+    """
+    HTML-escapes a snippet highlighted with the sentinels, then swaps the
+    sentinels for the `<mark>` tags.
+    """
+    return (
+        html.escape(snippet)
+        .replace(START_SENTINEL, START_SEL)
+        .replace(STOP_SENTINEL, STOP_SEL)
+    )
+
+
+def search_messages(query, chat_ids, before=None, limit=20):
+    """
+    Returns up to `limit` messages in the given chats matching the query,
+    best match first, with their `rank` and highlighted `snippet`. `before`
+    is the (rank, id) of the last result of the previous page.
+    """
+    if connection.vendor == "postgresql":
+        results = list(search_postgresql(query, chat_ids, before, limit))
+    else:
+        results = search_sqlite(query, chat_ids, before, limit)
+
+    for message in results:
+        message.snippet = highlight(message.snippet)
+    return results
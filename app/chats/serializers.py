@@ -1,7 +1,13 @@
 from os import read
+
 from rest_framework import serializers
 
-from .models import Chat, Message
+from users import profile_cards
+from users.serializers import ProfileCardListSerializer
+
+from .models import Chat, InboxEntry, Message
+
+MAX_BULK_MESSAGES = 100
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -14,25 +20,64 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = "__all__"
+        exclude = ["search_vector"]
         extra_kwargs = {
             "is_deleted": {"read_only": True},
             "created_at": {"read_only": True},
             "updated_at": {"read_only": True},
             "chat": {"write_only": True},
         }
+        list_serializer_class = ProfileCardListSerializer
+        # Retries with a used client_message_id return the original message
+        # (see `chats.idempotency`) instead of failing validation.
+        validators = []
+
+    def get_profile_card_ids(self, objs):
+        return [obj.sender_id for obj in objs]
 
     def get_sender_info(self, obj):
-        sender = obj.sender
+        card = profile_cards.get(obj.sender_id)
         return {
-            "id": str(sender.id),
-            "profile_picture": (
-                sender.profile_picture.url if sender.profile_picture else None
-            ),
-            "name": sender.name,
+            "id": card["id"],
+            "profile_picture": card["profile_picture"],
+            "name": card["name"],
         }
 
 
+class SearchResultSerializer(MessageSerializer):
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+
+class SendMessageSerializer(serializers.ModelSerializer):
+    """
+    Validates messages sent over a websocket, whose chat and sender come
+    from the connection instead of the payload.
+    """
+
+    class Meta:
+        model = Message
+        fields = ["text", "type", "reply_to", "is_forwarded", "client_message_id"]
+
+
+class BulkMessageItemSerializer(SendMessageSerializer):
+    chat_id = serializers.UUIDField()
+
+    class Meta(SendMessageSerializer.Meta):
+        fields = SendMessageSerializer.Meta.fields + ["chat_id"]
+
+
+class BulkMessageSerializer(serializers.Serializer):
+    """
+    Validates a bulk send. Chats are taken as plain ids and checked against
+    the sender's memberships, so validation does not query them one by one.
+    """
+
+    messages = BulkMessageItemSerializer(
+        many=True, allow_empty=False, max_length=MAX_BULK_MESSAGES
+    )
+
+
 class ChatSerializer(serializers.ModelSerializer):
     last_message = serializers.SerializerMethodField()
     profile_picture = serializers.SerializerMethodField()
@@ -42,25 +87,30 @@ class ChatSerializer(serializers.ModelSerializer):
         model = Chat
         fields = ["id", "type", "name", "profile_picture", "last_message"]
 
+    def get_other_user_card(self, obj):
+        if hasattr(obj, "other_user_id"):
+            other_user_id = obj.other_user_id
+        else:
+            other_user_id = (
+                obj.members.exclude(user=self.context["request"].user)
+                .values_list("user_id", flat=True)
+                .first()
+            )
+        return profile_cards.get(other_user_id) if other_user_id else None
+
     def get_profile_picture(self, obj):
         if obj.type == Chat.ChatTypes.individual:
-            other_user = (
-                obj.members.exclude(user=self.context["request"].user).first().user
-            )
-            profile_picture = other_user.profile_picture
-        else:
-            profile_picture = obj.profile_picture
+            other_user = self.get_other_user_card(obj)
+            return other_user["profile_picture"] if other_user else None
 
-        if not profile_picture:
+        if not obj.profile_picture:
             return None
-        return profile_picture.url
+        return obj.profile_picture.url
 
     def get_name(self, obj):
         if obj.type == Chat.ChatTypes.individual:
-            other_user = (
-                obj.members.exclude(user=self.context["request"].user).first().user
-            )
-            return other_user.name
+            other_user = self.get_other_user_card(obj)
+            return other_user["name"] if other_user else None
         return obj.name
 
     def get_last_message(self, obj):
@@ -72,5 +122,60 @@ class ChatSerializer(serializers.ModelSerializer):
         return None
 
 
+class InboxSerializer(serializers.ModelSerializer):
+    id = serializers.UUIDField(source="chat.id", read_only=True, format="hex_verbose")
+    type = serializers.CharField(source="chat.type", read_only=True)
+    name = serializers.SerializerMethodField()
+    profile_picture = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+
+    class Meta:
+        model = InboxEntry
+        fields = [
+            "id",
+            "type",
+            "name",
+            "profile_picture",
+            "last_message",
+            "last_activity_at",
+            "unread_count",
+        ]
+        list_serializer_class = ProfileCardListSerializer
+
+    def get_profile_card_ids(self, objs):
+        user_ids = [obj.peer_id for obj in objs]
+        user_ids += [obj.last_message.sender_id for obj in objs if obj.last_message]
+        return user_ids
+
+    def get_peer_card(self, obj):
+        return profile_cards.get(obj.peer_id) if obj.peer_id else None
+
+    def get_profile_picture(self, obj):
+        if obj.chat.type == Chat.ChatTypes.individual:
+            peer = self.get_peer_card(obj)
+            return peer["profile_picture"] if peer else None
+
+        if not obj.chat.profile_picture:
+            return None
+        return obj.chat.profile_picture.url
+
+    def get_name(self, obj):
+        if obj.chat.type == Chat.ChatTypes.individual:
+            peer = self.get_peer_card(obj)
+            return peer["name"] if peer else None
+        return obj.chat.name
+
+    def get_last_message(self, obj):
+        last_message = obj.last_message
+        if last_message:
+            last_message.chat = obj.chat
+            return MessageSerializer(last_message).data
+        return None
+
+
 class CreatePrivateChatSerializer(serializers.Serializer):
     user_id = serializers.UUIDField()
+
+
+class MessageCursorSerializer(serializers.Serializer):
+    message_id = serializers.UUIDField()
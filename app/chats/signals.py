@@ -1,77 +1,165 @@
-import asyncio
-import datetime
-
-from django.db.models.signals import post_save
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_migrate, post_save
 from django.dispatch import receiver
-from django.utils import timezone
 
-from channels.layers import get_channel_layer
+from . import idempotency, membership, search
 
-from chats.serializers import MessageSerializer
-from chats.utils import get_active_users_in_chat, get_all_active_users
+from .models import (
+    Chat,
+    ChatEvent,
+    ChatParticipant,
+    InboxEntry,
+    Message,
+    MessageOutbox,
+    message_deleted,
+)
 
-from .models import Message
 
+@receiver(post_save, sender=ChatParticipant)
+def create_inbox_entry(sender, instance, created, **kwargs):
+    """
+    Gives every new chat participant a row in their inbox.
+    """
+    if created:
+        InboxEntry.create_for_participant(instance)
 
-@receiver(post_save, sender=Message)
-def send_message_to_chat(sender, instance, **kwargs):
-    """
-    Sends a message to the chat in real-time.
-    """
-    try:
-        channel_layer = get_channel_layer()
-        room_group_name = f"chat_{instance.chat.id}"
-        print("room_group_name", room_group_name)
-        active_users_in_chat = get_active_users_in_chat(instance.chat.id)
-        all_active_users = get_all_active_users()
-
-        users_not_active_in_chat = set(
-            map(
-                str,
-                instance.chat.members.filter()
-                .exclude(user__id__in=active_users_in_chat, user__id=instance.sender.id)
-                .values_list("user__id", flat=True),
-            )
+
+@receiver(post_save, sender=ChatParticipant)
+def invalidate_membership(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Drops the cached membership sets when a participant joins or leaves.
+    Cursor updates, which save with `update_fields`, leave them alone.
+    """
+    if created or update_fields is None or "left_at" in update_fields:
+        transaction.on_commit(
+            lambda: membership.invalidate(instance.chat_id, instance.user_id)
         )
-        online_users_not_active_in_chat = users_not_active_in_chat.intersection(
-            all_active_users
+
+
+@receiver(post_delete, sender=ChatParticipant)
+def invalidate_membership_on_delete(sender, instance, **kwargs):
+    transaction.on_commit(
+        lambda: membership.invalidate(instance.chat_id, instance.user_id)
+    )
+
+
+@receiver(post_save, sender=Message)
+def update_inbox_entries(sender, instance, created, **kwargs):
+    """
+    Keeps the inbox entries of the chat in sync with its messages.
+    """
+    if created:
+        InboxEntry.record_message(instance)
+    elif instance.is_deleted:
+        InboxEntry.record_deletion(instance, instance.unread_by())
+
+
+@receiver(post_save, sender=Message)
+def add_message_to_outbox(sender, instance, created, **kwargs):
+    """
+    Queues new messages for real-time delivery by the outbox dispatcher.
+    """
+    if created:
+        MessageOutbox.objects.create(message=instance)
+
+
+@receiver(post_save, sender=Message)
+def remember_client_message_id(sender, instance, created, **kwargs):
+    """
+    Records the message's client message id in Redis once it is committed,
+    so retries of the send are answered from there.
+    """
+    if created and instance.client_message_id:
+        transaction.on_commit(lambda: idempotency.remember(instance))
+
+
+def is_deleted_with(origin, model):
+    """
+    Returns whether a deletion was started by an instance or queryset of
+    the given model, rather than on the object itself.
+    """
+    if isinstance(origin, QuerySet):
+        return origin.model is model
+    return isinstance(origin, model)
+
+
+@receiver(post_save, sender=Message)
+def log_message_event(sender, instance, created, **kwargs):
+    """
+    Logs message changes for the sync endpoint.
+    """
+    if created:
+        kind = ChatEvent.Kinds.message_created
+    elif instance.is_deleted:
+        kind = ChatEvent.Kinds.message_deleted
+    else:
+        kind = ChatEvent.Kinds.message_updated
+    ChatEvent.objects.create(
+        chat_id=instance.chat_id, kind=kind, message_id=instance.id
+    )
+
+
+# Message deletes are handled through `message_deleted` rather than
+# `post_delete`, whose receivers would load and delete every message of a
+# deleted chat or user one by one.
+@receiver(message_deleted)
+def log_message_deleted_event(sender, instance, message_id, **kwargs):
+    ChatEvent.objects.create(
+        chat_id=instance.chat_id,
+        kind=ChatEvent.Kinds.message_deleted,
+        message_id=message_id,
+    )
+
+
+@receiver(post_save, sender=ChatParticipant)
+def log_member_event(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Logs members joining and leaving chats for the sync endpoint.
+    """
+    if created:
+        kind = ChatEvent.Kinds.member_joined
+    elif instance.left_at and (update_fields is None or "left_at" in update_fields):
+        kind = ChatEvent.Kinds.member_left
+    else:
+        return
+    ChatEvent.objects.create(
+        chat_id=instance.chat_id, kind=kind, user_id=instance.user_id
+    )
+
+
+@receiver(post_delete, sender=ChatParticipant)
+def log_member_removed_event(sender, instance, origin=None, **kwargs):
+    if not is_deleted_with(origin, Chat) and not is_deleted_with(
+        origin, get_user_model()
+    ):
+        ChatEvent.objects.create(
+            chat_id=instance.chat_id,
+            kind=ChatEvent.Kinds.member_removed,
+            user_id=instance.user_id,
         )
-        print("active_users_in_chat", active_users_in_chat)
-        print("all_active_users", all_active_users)
-        print("users_not_active_in_chat", users_not_active_in_chat)
-        print("online_users_not_active_in_chat", online_users_not_active_in_chat)
-
-        async def send_to_group():
-            try:
-                message = MessageSerializer(instance).data
-                print("message", message)
-                await channel_layer.group_send(
-                    room_group_name,
-                    {"type": "chat_message", "message": message},
-                )
-                print("sent to group")
-
-                for user_id in online_users_not_active_in_chat:
-                    print("sending to user")
-                    channel_name = "user_%s" % user_id
-                    await channel_layer.group_send(
-                        channel_name,
-                        {
-                            "type": "notify_message",
-                            "message": message,
-                        },
-                    )
-            except:
-                print("error sending to group")
-                import traceback
-
-                traceback.print_exc()
-
-        try:
-            loop = asyncio.get_running_loop()
-            loop.create_task(send_to_group())
-        except RuntimeError:
-            asyncio.run(send_to_group())
-
-    except Exception as e:
-        print(f"Error in pre_save signal: {e}")
+
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, **kwargs):
+    """
+    Keeps the full-text search index in sync with the message's text.
+    """
+    search.index_messages([instance])
+
+
+@receiver(message_deleted)
+def unindex_message(sender, instance, message_id, **kwargs):
+    search.unindex_messages([message_id])
+
+
+@receiver(post_delete, sender=Chat)
+def unindex_chat(sender, instance, **kwargs):
+    search.unindex_chat(instance.id)
+
+
+@receiver(post_migrate)
+def create_search_index(sender, using, **kwargs):
+    if sender.name == "chats":
+        search.create_search_index(using)
@@ -0,0 +1,94 @@
+"""
+Delta sync for reconnecting clients.
+
+`stream_events` writes a page of `ChatEvent`s as one JSON object,
+
+    {"events": [...], "cursor": "<id of the last event>", "has_more": false}
+
+rendered chunk by chunk from a server-side cursor, with the current state
+of the messages they refer to loaded once per chunk. It is an async
+generator, so ASGI servers send each chunk as it is rendered.
+"""
+
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from core import fastjson
+
+from .models import ChatEvent, Message
+from .serializers import MessageSerializer
+
+PAGE_SIZE = 500
+MAX_PAGE_SIZE = 2000
+CHUNK_SIZE = 100
+
+MESSAGE_KINDS = {ChatEvent.Kinds.message_created, ChatEvent.Kinds.message_updated}
+
+
+def serialize_chunk(events):
+    message_ids = [event.message_id for event in events if event.kind in MESSAGE_KINDS]
+    messages = (
+        Message.objects.filter(is_deleted=False)
+        .select_related("chat")
+        .in_bulk(message_ids)
+    )
+    data = {
+        message["id"]: message
+        for message in MessageSerializer(list(messages.values()), many=True).data
+    }
+
+    for event in events:
+        yield {
+            "id": str(event.id),
+            "type": event.kind,
+            "chat_id": event.chat_id,
+            "message_id": event.message_id,
+            "user_id": event.user_id,
+            "created_at": event.created_at,
+            # None when it was deleted since, soft or hard, which a later
+            # event reports.
+            "message": data.get(str(event.message_id)),
+        }
+
+
+def render_next_chunk(events, size, first):
+    """
+    Reads up to `size` events from the iterator and renders them. Returns
+    the rendered bytes and the events read.
+    """
+    chunk = list(islice(events, size))
+    if not chunk:
+        return b"", chunk
+    body = b",".join(fastjson.dumps(item) for item in serialize_chunk(chunk))
+    return (body if first else b"," + body), chunk
+
+
+async def stream_events(events, cursor, page_size):
+    """
+    Yields the first `page_size` of the given events, ordered by id, as
+    chunks of one JSON document. Each chunk is read and rendered off the
+    event loop, so only one chunk is held in memory under ASGI.
+    """
+    yield b'{"events":['
+
+    events = events[: page_size + 1].iterator(chunk_size=CHUNK_SIZE)
+    count = 0
+    while count < page_size:
+        body, chunk = await sync_to_async(render_next_chunk)(
+            events, min(CHUNK_SIZE, page_size - count), count == 0
+        )
+        if not chunk:
+            break
+        count += len(chunk)
+        cursor = chunk[-1].id
+        yield body
+
+    has_more = False
+    if count == page_size:
+        has_more = bool(await sync_to_async(list)(islice(events, 1)))
+
+    yield b'],"cursor":%s,"has_more":%s}' % (
+        fastjson.dumps(str(cursor)),
+        fastjson.dumps(has_more),
+    )
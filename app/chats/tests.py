@@ -1,3 +1,1387 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import uuid
 
-# Create your tests here.
+from base64 import b64encode
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import SkipTest, mock
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.exceptions import ParseError
+from rest_framework.test import APIClient
+
+from core.channel_layers import BulkRedisChannelLayer
+from core.parsers import FastJSONParser
+from core.renderers import FastJSONRenderer
+
+from . import membership, presence, receipts, search, typing
+from .utils import redis_client
+from .models import (
+    Chat,
+    ChatEvent,
+    ChatParticipant,
+    InboxEntry,
+    Message,
+    MessageMedia,
+    MessageOutbox,
+    MessageStatus,
+)
+
+
+def create_user(index, **extra_fields):
+    return get_user_model().objects.create(
+        phone_number="+234800000%04d" % index, name="user %s" % index, **extra_fields
+    )
+
+
+def read_streaming_content(response):
+    async def read():
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    return async_to_sync(read)()
+
+
+class ChatInboxTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_chats(self, count, offset=0):
+        for index in range(offset + 1, offset + count + 1):
+            other_user = create_user(index)
+            chat = Chat.objects.create(type=Chat.ChatTypes.individual)
+            chat.members.create(user=self.user)
+            chat.members.create(user=other_user)
+            Message.objects.create(chat=chat, sender=other_user, text="hello")
+
+    def count_list_queries(self, page_size):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse("chats:chat-list"), {"page_size": page_size}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), page_size)
+        return len(queries)
+
+    def test_list_returns_other_user_and_last_message(self):
+        self.create_chats(1)
+
+        response = self.client.get(reverse("chats:chat-list"))
+
+        chat = response.data["results"][0]
+        self.assertEqual(chat["name"], "user 1")
+        self.assertEqual(chat["last_message"]["text"], "hello")
+        self.assertEqual(chat["last_message"]["sender_info"]["name"], "user 1")
+
+    def test_list_query_count_is_independent_of_page_size(self):
+        self.create_chats(2)
+        small_page_queries = self.count_list_queries(2)
+
+        self.create_chats(18, offset=2)
+        large_page_queries = self.count_list_queries(20)
+
+        self.assertEqual(small_page_queries, large_page_queries)
+
+    def test_list_is_ordered_by_last_activity(self):
+        self.create_chats(2)
+        oldest_chat = Chat.objects.order_by("created_at").first()
+        other_user = oldest_chat.members.exclude(user=self.user).first().user
+        Message.objects.create(chat=oldest_chat, sender=other_user, text="again")
+
+        response = self.client.get(reverse("chats:chat-list"))
+
+        chat = response.data["results"][0]
+        self.assertEqual(chat["id"], str(oldest_chat.id))
+        self.assertEqual(chat["last_message"]["text"], "again")
+        self.assertEqual(chat["unread_count"], 2)
+
+    def test_deleting_last_message_falls_back_to_previous_one(self):
+        self.create_chats(1)
+        chat = Chat.objects.get()
+        message = Message.objects.create(chat=chat, sender=self.user, text="bye")
+
+        message.is_deleted = True
+        message.save()
+
+        response = self.client.get(reverse("chats:chat-list"))
+        self.assertEqual(response.data["results"][0]["last_message"]["text"], "hello")
+
+    def test_deleting_unread_messages_updates_the_counts(self):
+        self.create_chats(1)
+        chat = Chat.objects.get()
+        other_user = chat.members.exclude(user=self.user).get().user
+        Message.objects.update(created_at=timezone.now() - datetime.timedelta(days=1))
+        InboxEntry.objects.update(
+            last_activity_at=timezone.now() - datetime.timedelta(days=1)
+        )
+        first = Message.objects.create(chat=chat, sender=other_user, text="one")
+        second = Message.objects.create(chat=chat, sender=other_user, text="two")
+
+        second.is_deleted = True
+        second.save()
+        entry = InboxEntry.objects.get(user=self.user)
+        self.assertEqual(entry.unread_count, 2)
+        self.assertEqual(entry.last_message, first)
+        self.assertEqual(entry.last_activity_at, first.created_at)
+
+        first.delete()
+        Message.objects.filter(text="hello").get().delete()
+        entry.refresh_from_db()
+        self.assertEqual(entry.unread_count, 0)
+        self.assertIsNone(entry.last_message)
+        self.assertEqual(entry.last_activity_at, entry.participant.created_at)
+
+    def test_deleting_read_messages_keeps_the_counts(self):
+        self.create_chats(1)
+        chat = Chat.objects.get()
+        other_user = chat.members.exclude(user=self.user).get().user
+        read = Message.objects.create(chat=chat, sender=other_user, text="read")
+        chat.members.get(user=self.user).mark_read(read)
+        Message.objects.create(chat=chat, sender=other_user, text="unread")
+
+        read.is_deleted = True
+        read.save()
+
+        self.assertEqual(InboxEntry.objects.get(user=self.user).unread_count, 1)
+
+    def count_chat_delete_queries(self, message_count):
+        other_user = create_user(message_count)
+        chat, _ = Chat.get_or_create_direct(self.user, other_user)
+        for index in range(message_count):
+            Message.objects.create(chat=chat, sender=other_user, text=str(index))
+
+        chat_id = chat.id
+        with CaptureQueriesContext(connection) as queries:
+            chat.delete()
+        self.assertFalse(Message.objects.filter(chat_id=chat_id).exists())
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT COUNT(*) FROM %s WHERE chat_id = %%s" % search.FTS_TABLE,
+                    [chat_id.hex],
+                )
+                self.assertEqual(cursor.fetchone()[0], 0)
+        return len(queries)
+
+    def test_deleting_a_chat_deletes_its_messages_in_bulk(self):
+        self.assertEqual(
+            self.count_chat_delete_queries(5), self.count_chat_delete_queries(50)
+        )
+
+
+class ReadCursorTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.first_member = create_user(1)
+        self.second_member = create_user(2)
+        self.chat = Chat.objects.create(type=Chat.ChatTypes.group, name="group")
+        for user in (self.user, self.first_member, self.second_member):
+            self.chat.members.create(user=user)
+        self.messages = [
+            Message.objects.create(chat=self.chat, sender=self.user, text=str(index))
+            for index in range(3)
+        ]
+        self.client = APIClient()
+
+    def participant(self, user):
+        return ChatParticipant.objects.get(chat=self.chat, user=user)
+
+    def test_read_moves_cursor_forward_only(self):
+        self.client.force_authenticate(self.first_member)
+        url = reverse("chats:chat-mark-read", kwargs={"chat_id": self.chat.id})
+
+        response = self.client.post(url, {"message_id": self.messages[1].id})
+        self.assertEqual(response.data["data"]["unread_count"], 1)
+
+        self.client.post(url, {"message_id": self.messages[0].id})
+        participant = self.participant(self.first_member)
+        self.assertEqual(participant.last_read_message, self.messages[1])
+        self.assertEqual(participant.last_delivered_message, self.messages[1])
+        self.assertEqual(participant.inbox_entry.unread_count, 1)
+
+    def test_receipts_count_members_past_the_message(self):
+        self.participant(self.first_member).mark_read(self.messages[2])
+        self.participant(self.second_member).mark_delivered(self.messages[1])
+
+        self.client.force_authenticate(self.user)
+        response = self.client.get(
+            reverse(
+                "chats:chat-receipts",
+                kwargs={"chat_id": self.chat.id, "message_id": self.messages[1].id},
+            )
+        )
+
+        self.assertEqual(
+            response.data["data"], {"members": 2, "delivered_to": 2, "read_by": 1}
+        )
+
+    def test_compact_message_statuses(self):
+        MessageStatus.objects.create(
+            user=self.first_member,
+            message=self.messages[1],
+            status=MessageStatus.Status.read,
+        )
+        MessageStatus.objects.create(user=self.first_member, message=self.messages[2])
+
+        call_command("compact_message_statuses", "--delete", stdout=StringIO())
+
+        participant = self.participant(self.first_member)
+        self.assertEqual(participant.last_read_message, self.messages[1])
+        self.assertEqual(participant.last_delivered_message, self.messages[2])
+        self.assertFalse(MessageStatus.objects.exists())
+
+
+class MessageHistoryTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.chat = Chat.objects.create(type=Chat.ChatTypes.group, name="group")
+        self.chat.members.create(user=self.user)
+        self.messages = [
+            Message.objects.create(chat=self.chat, sender=self.user, text=str(index))
+            for index in range(5)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse("chats:chat-messages", kwargs={"chat_id": self.chat.id})
+
+    def test_scrolls_back_through_history_with_before_cursor(self):
+        texts = []
+        params = {"page_size": 2}
+        while True:
+            response = self.client.get(self.url, params)
+            texts += [message["text"] for message in response.data["results"]]
+            if not response.data["links"]["next"]:
+                break
+            params["before"] = response.data["cursors"]["before"]
+
+        self.assertEqual(texts, ["4", "3", "2", "1", "0"])
+
+    def test_after_cursor_returns_newer_messages(self):
+        response = self.client.get(self.url, {"page_size": 2})
+        oldest_page = self.client.get(
+            self.url, {"page_size": 2, "before": response.data["cursors"]["before"]}
+        )
+
+        response = self.client.get(
+            self.url, {"page_size": 2, "after": oldest_page.data["cursors"]["after"]}
+        )
+
+        texts = [message["text"] for message in response.data["results"]]
+        self.assertEqual(texts, ["4", "3"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {"before": "not-a-cursor"})
+        self.assertEqual(response.status_code, 404)
+
+
+class DirectChatTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.other_user = create_user(1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse("chats:chat-get-conversation-id")
+
+    def test_reuses_direct_chat_from_either_side(self):
+        response = self.client.post(self.url, {"user_id": self.other_user.id})
+        chat = Chat.objects.get(id=response.data["data"])
+        self.assertEqual(chat.members.count(), 2)
+
+        self.client.force_authenticate(self.other_user)
+        response = self.client.post(self.url, {"user_id": self.user.id})
+
+        self.assertEqual(response.data["data"], chat.id)
+        self.assertEqual(Chat.objects.count(), 1)
+
+    def test_group_chat_is_not_reused(self):
+        group = Chat.objects.create(type=Chat.ChatTypes.group, name="group")
+        group.members.create(user=self.user)
+        group.members.create(user=self.other_user)
+
+        response = self.client.post(self.url, {"user_id": self.other_user.id})
+
+        self.assertNotEqual(response.data["data"], group.id)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+class MessageOutboxTests(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.other_user = create_user(1)
+        self.chat, _ = Chat.get_or_create_direct(self.user, self.other_user)
+
+    def test_only_new_messages_are_queued(self):
+        message = Message.objects.create(chat=self.chat, sender=self.user, text="hi")
+        message.text = "edited"
+        message.save()
+        message.is_deleted = True
+        message.save()
+
+        self.assertEqual(MessageOutbox.objects.filter(message=message).count(), 1)
+
+    @mock.patch("chats.presence.get_online_users", return_value=set())
+    @mock.patch("chats.presence.get_active_users_in_chat", return_value=set())
+    def test_dispatch_sends_to_chat_room_and_clears_outbox(self, *mocks):
+        message = Message.objects.create(chat=self.chat, sender=self.user, text="hi")
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)("chat_%s" % self.chat.id, channel_name)
+
+        call_command("dispatch_outbox", "--once", stdout=StringIO())
+
+        event = async_to_sync(channel_layer.receive)(channel_name)
+        self.assertEqual(json.loads(event["frame"])["message"]["id"], str(message.id))
+        self.assertFalse(MessageOutbox.objects.exists())
+
+    @mock.patch("chats.presence.get_active_users_in_chat", return_value=set())
+    def test_dispatch_notifies_online_members_outside_the_chat(self, *mocks):
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(
+            "user_%s" % self.other_user.id, channel_name
+        )
+
+        with mock.patch(
+            "chats.presence.get_online_users", return_value={str(self.other_user.id)}
+        ):
+            Message.objects.create(chat=self.chat, sender=self.user, text="hi")
+            call_command("dispatch_outbox", "--once", stdout=StringIO())
+
+        event = async_to_sync(channel_layer.receive)(channel_name)
+        self.assertEqual(event["type"], "notify_message")
+
+    @mock.patch("chats.presence.get_active_users_in_chat", side_effect=OSError)
+    def test_failed_dispatch_is_retried_later(self, *mocks):
+        Message.objects.create(chat=self.chat, sender=self.user, text="hi")
+
+        call_command("dispatch_outbox", "--once", stdout=StringIO(), stderr=StringIO())
+
+        entry = MessageOutbox.objects.get()
+        self.assertEqual(entry.attempts, 1)
+        self.assertIsNotNone(entry.last_error)
+
+    @mock.patch("chats.presence.get_online_users", return_value=set())
+    @mock.patch("chats.presence.get_active_users_in_chat", return_value=set())
+    def test_dispatch_keeps_the_order_within_a_chat(self, *mocks):
+        messages = [
+            Message.objects.create(chat=self.chat, sender=self.user, text=str(index))
+            for index in range(3)
+        ]
+        failing = messages[1].id
+        sent = []
+
+        async def dispatch_message(message, channel_layer):
+            await asyncio.sleep(0.01 if message.id == messages[0].id else 0)
+            if message.id == failing:
+                raise OSError
+            sent.append(message.id)
+
+        with mock.patch(
+            "chats.management.commands.dispatch_outbox.dispatch_message",
+            dispatch_message,
+        ):
+            call_command(
+                "dispatch_outbox", "--once", stdout=StringIO(), stderr=StringIO()
+            )
+            self.assertEqual(sent, [messages[0].id])
+            self.assertEqual(
+                set(MessageOutbox.objects.values_list("message_id", flat=True)),
+                {messages[1].id, messages[2].id},
+            )
+
+            # The later message waits for the failed one's retry.
+            failing = None
+            MessageOutbox.objects.filter(message=messages[2]).update(
+                available_at=timezone.now()
+            )
+            call_command("dispatch_outbox", "--once", stdout=StringIO())
+            self.assertEqual(sent, [messages[0].id])
+
+            MessageOutbox.objects.update(available_at=timezone.now())
+            call_command("dispatch_outbox", "--once", stdout=StringIO())
+
+        self.assertEqual(sent, [message.id for message in messages])
+        self.assertFalse(MessageOutbox.objects.exists())
+
+    @mock.patch("chats.presence.get_active_users_in_chat", side_effect=OSError)
+    def test_exhausted_entries_are_given_up_on(self, *mocks):
+        message = Message.objects.create(chat=self.chat, sender=self.user, text="hi")
+        stderr = StringIO()
+
+        call_command(
+            "dispatch_outbox",
+            "--once",
+            "--max-attempts",
+            "1",
+            stdout=StringIO(),
+            stderr=stderr,
+        )
+
+        self.assertFalse(MessageOutbox.objects.exists())
+        self.assertIn("Giving up on message %s" % message.id, stderr.getvalue())
+
+
+class BulkRedisChannelLayerTests(SimpleTestCase):
+    """
+    Runs `group_send_many` against the Redis it is configured with, and is
+    skipped when that Redis cannot be reached.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            redis_client.ping()
+        except Exception as e:
+            raise SkipTest(f"Redis is not reachable: {e}")
+        super().setUpClass()
+
+    def test_every_channel_of_the_groups_receives_the_message_once(self):
+        async_to_sync(self.check_group_send_many)()
+
+    async def check_group_send_many(self):
+        channel_layer = BulkRedisChannelLayer(
+            hosts=[settings.CACHES["default"]["LOCATION"]],
+            prefix="test-%s" % uuid.uuid4().hex,
+        )
+        try:
+            groups = ["user_%s" % index for index in range(3)]
+            channels = [await channel_layer.new_channel() for _ in range(6)]
+            # Every channel is in two of the groups.
+            for index, channel in enumerate(channels):
+                for group in (groups[index % 3], groups[(index + 1) % 3]):
+                    await channel_layer.group_add(group, channel)
+            outsider = await channel_layer.new_channel()
+
+            await channel_layer.group_send_many(
+                groups + ["user_without_channels"],
+                {"type": "notify_message", "frame": "hi"},
+            )
+
+            for channel in channels:
+                self.assertEqual((await channel_layer.receive(channel))["frame"], "hi")
+            for channel in channels + [outsider]:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(channel_layer.receive(channel), 0.1)
+        finally:
+            await channel_layer.flush()
+            await channel_layer.close_pools()
+
+
+class FastJSONTests(TestCase):
+    def test_renders_uuids_datetimes_and_decimals(self):
+        value = {
+            "id": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+            "created_at": datetime.datetime(2025, 1, 2, 3, 4, 5, tzinfo=datetime.UTC),
+            "amount": Decimal("1.50"),
+        }
+
+        rendered = json.loads(FastJSONRenderer().render(value))
+
+        self.assertEqual(
+            rendered,
+            {
+                "id": "12345678-1234-5678-1234-567812345678",
+                "created_at": "2025-01-02T03:04:05Z",
+                "amount": "1.50",
+            },
+        )
+
+    def test_invalid_json_is_a_parse_error(self):
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(BytesIO(b"{not json"))
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class BenchmarkCommandTests(TestCase):
+    def test_bench_json_runs_on_real_payloads(self):
+        user, other_user = create_user(0), create_user(1)
+        chat, _ = Chat.get_or_create_direct(user, other_user)
+        Message.objects.create(chat=chat, sender=user, text="hello")
+        stdout = StringIO()
+
+        call_command("bench_json", "--number", "1", stdout=stdout)
+
+        self.assertIn("FastJSONRenderer", stdout.getvalue())
+
+
+class PresenceHeartbeatTests(TestCase):
+    @mock.patch("chats.presence._atouch")
+    def test_pings_are_coalesced_until_half_the_ttl_is_left(self, touch):
+        heartbeat = presence.PresenceHeartbeat("user")
+
+        with mock.patch("time.monotonic", return_value=100):
+            async_to_sync(heartbeat.online)()
+            async_to_sync(heartbeat.online)()
+        self.assertEqual(touch.call_count, 1)
+
+        with mock.patch("time.monotonic", return_value=100 + presence.ONLINE_TTL / 2):
+            async_to_sync(heartbeat.online)()
+        self.assertEqual(touch.call_count, 2)
+
+    @mock.patch("chats.presence.amark_inactive_in_chat")
+    @mock.patch("chats.presence._atouch")
+    def test_rejoining_a_chat_writes_again(self, touch, mark_inactive):
+        heartbeat = presence.PresenceHeartbeat("user")
+
+        async_to_sync(heartbeat.active_in_chat)("chat")
+        async_to_sync(heartbeat.inactive_in_chat)("chat")
+        async_to_sync(heartbeat.active_in_chat)("chat")
+
+        self.assertEqual(touch.call_count, 2)
+        mark_inactive.assert_called_once_with("chat", "user")
+
+
+class FakeSortedSets:
+    """
+    In-memory stand-in for the Redis sorted set commands used by presence,
+    with the same API for the sync and asyncio clients.
+    """
+
+    def __init__(self, asynchronous=False):
+        self.sets = {}
+        self.asynchronous = asynchronous
+        self.commands = []
+
+    def pipeline(self, transaction=True):
+        self.commands = []
+        return self
+
+    def _run(self, result):
+        if not self.asynchronous:
+            return result
+
+        async def run():
+            return result
+
+        return run()
+
+    def execute(self):
+        results = [command() for command in self.commands]
+        self.commands = []
+        return self._run(results)
+
+    def _queue(self, command):
+        self.commands.append(command)
+
+    def zadd(self, key, mapping):
+        self._queue(lambda: self.sets.setdefault(key, {}).update(mapping))
+
+    def zremrangebyscore(self, key, low, high):
+        def command():
+            members = self.sets.get(key, {})
+            for member, score in list(members.items()):
+                if float(low) <= score <= float(high):
+                    del members[member]
+
+        self._queue(command)
+
+    def zrangebyscore(self, key, low, high):
+        self._queue(
+            lambda: [
+                member.encode()
+                for member, score in self.sets.get(key, {}).items()
+                if float(low) <= score <= float(high)
+            ]
+        )
+
+    def expire(self, key, ttl):
+        self._queue(lambda: True)
+
+    def zrem(self, key, member):
+        return self._run(self.sets.get(key, {}).pop(member, None))
+
+    def zmscore(self, key, members):
+        scores = self.sets.get(key, {})
+        return self._run([scores.get(member) for member in members])
+
+
+class PresenceRegistryTests(TestCase):
+    def setUp(self):
+        self.redis_client = FakeSortedSets()
+        self.async_redis_client = FakeSortedSets(asynchronous=True)
+        # Both clients read and write the same sets.
+        self.async_redis_client.sets = self.redis_client.sets
+        for name, client in (
+            ("redis_client", self.redis_client),
+            ("async_redis_client", self.async_redis_client),
+        ):
+            patcher = mock.patch("chats.presence.%s" % name, client)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def touch(self, now, key, user_id, ttl):
+        with mock.patch("time.time", return_value=now):
+            async_to_sync(presence._atouch)(key, user_id, ttl)
+
+    def test_online_users_are_filtered_by_expiry(self):
+        self.touch(100, presence.ONLINE_KEY, "fresh", presence.ONLINE_TTL)
+        self.touch(100, presence.ONLINE_KEY, "stale", 5)
+
+        with mock.patch("time.time", return_value=110):
+            self.assertEqual(
+                presence.get_online_users(["fresh", "stale", "unknown"]), {"fresh"}
+            )
+            self.assertEqual(
+                async_to_sync(presence.aget_online_users)(["fresh", "stale"]),
+                {"fresh"},
+            )
+            self.assertEqual(presence.get_online_users([]), set())
+
+    def test_expired_members_are_trimmed_on_write_and_read(self):
+        key = presence.CHAT_KEY % "chat"
+        self.touch(100, key, "first", 5)
+        self.touch(110, key, "second", presence.CHAT_TTL)
+        self.assertEqual(set(self.redis_client.sets[key]), {"second"})
+
+        with mock.patch("time.time", return_value=100 + presence.CHAT_TTL + 11):
+            self.assertEqual(presence.get_active_users_in_chat("chat"), set())
+        self.assertEqual(self.redis_client.sets[key], {})
+
+    def test_chat_sets_are_separate_from_the_online_set(self):
+        self.touch(100, presence.ONLINE_KEY, "user", presence.ONLINE_TTL)
+        self.touch(100, presence.CHAT_KEY % "chat", "user", presence.CHAT_TTL)
+        self.touch(100, presence.CHAT_KEY % "other", "other_user", presence.CHAT_TTL)
+
+        async_to_sync(presence.amark_inactive_in_chat)("chat", "user")
+
+        with mock.patch("time.time", return_value=105):
+            self.assertEqual(presence.get_active_users_in_chat("chat"), set())
+            self.assertEqual(presence.get_active_users_in_chat("other"), {"other_user"})
+            self.assertEqual(presence.get_online_users(["user"]), {"user"})
+
+
+class MembershipTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.chat = Chat.objects.create(type=Chat.ChatTypes.group)
+        self.participant = self.chat.members.create(user=self.user)
+
+    @mock.patch("chats.membership.redis_client")
+    def test_cached_set_answers_without_a_query(self, redis_client):
+        redis_client.pipeline.return_value.execute.return_value = [1, 1, None]
+
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_member(self.chat.id, self.user.id))
+
+    @mock.patch("chats.membership.redis_client")
+    def test_missing_set_is_filled_at_the_generation_it_was_read_at(self, redis_client):
+        key = membership.USER_KEY % self.user.id
+        redis_client.pipeline.return_value.execute.return_value = [0, 0, b"4"]
+
+        self.assertTrue(membership.is_member(self.chat.id, self.user.id))
+        redis_client.eval.assert_called_once_with(
+            membership.FILL_SCRIPT,
+            2,
+            key,
+            membership.GENERATION_KEY % key,
+            "4",
+            membership.TTL,
+            membership.PLACEHOLDER,
+            str(self.chat.id),
+        )
+
+    @mock.patch("chats.membership.redis_client")
+    def test_invalidate_bumps_the_generations(self, redis_client):
+        pipeline = redis_client.pipeline.return_value
+
+        membership.invalidate(self.chat.id, self.user.id)
+
+        for key in (
+            membership.USER_KEY % self.user.id,
+            membership.CHAT_KEY % self.chat.id,
+        ):
+            pipeline.incr.assert_any_call(membership.GENERATION_KEY % key)
+            pipeline.delete.assert_any_call(key)
+        pipeline.execute.assert_called_once()
+
+    @mock.patch("chats.membership.redis_client")
+    def test_chat_ids_are_normalized(self, redis_client):
+        pipeline = redis_client.pipeline.return_value
+        pipeline.execute.return_value = [1, 1, None]
+
+        self.assertTrue(membership.is_member(self.chat.id.hex.upper(), self.user.id))
+        pipeline.sismember.assert_called_once_with(
+            membership.USER_KEY % self.user.id, str(self.chat.id)
+        )
+        self.assertFalse(membership.is_member("not-a-uuid", self.user.id))
+
+    @mock.patch("chats.membership.redis_client")
+    def test_falls_back_to_database_when_redis_is_down(self, redis_client):
+        redis_client.pipeline.return_value.execute.side_effect = OSError
+
+        self.assertTrue(membership.is_member(self.chat.id, self.user.id))
+        self.assertEqual(membership.get_member_ids(self.chat.id), {str(self.user.id)})
+
+        self.participant.left_at = datetime.datetime.now(datetime.timezone.utc)
+        self.participant.save()
+        self.assertFalse(membership.is_member(self.chat.id, self.user.id))
+
+    @mock.patch("chats.membership.invalidate")
+    def test_joining_and_leaving_invalidates_the_sets(self, invalidate):
+        other_user = create_user(1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            participant = self.chat.members.create(user=other_user)
+        invalidate.assert_called_once_with(self.chat.id, other_user.id)
+
+        message = Message.objects.create(chat=self.chat, sender=self.user, text="hi")
+        with self.captureOnCommitCallbacks(execute=True):
+            participant.mark_read(message)
+        self.assertEqual(invalidate.call_count, 1)
+
+        participant.left_at = message.created_at
+        with self.captureOnCommitCallbacks(execute=True):
+            participant.save()
+        self.assertEqual(invalidate.call_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            participant.delete()
+        self.assertEqual(invalidate.call_count, 3)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+class TypingIndicatorTests(TestCase):
+    def setUp(self):
+        self.keys = {}
+        patcher = mock.patch("chats.typing.async_redis_client")
+        redis_client = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        async def set(key, value, nx=False, ex=None):
+            if nx and key in self.keys:
+                return None
+            self.keys[key] = value
+            return True
+
+        async def delete(*keys):
+            for key in keys:
+                self.keys.pop(key, None)
+
+        redis_client.set.side_effect = set
+        redis_client.delete.side_effect = delete
+
+    def test_typing_frames_are_coalesced(self):
+        async_to_sync(self.check_coalescing)()
+
+    async def check_coalescing(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("chat_chat", channel_name)
+        indicator = typing.TypingIndicator(channel_layer, "user")
+
+        for _ in range(5):
+            await indicator.typing("chat")
+        await indicator.stop_typing("chat")
+        await indicator.stop_typing("chat")
+
+        events = [await channel_layer.receive(channel_name) for _ in range(2)]
+        self.assertEqual(
+            [json.loads(event["frame"])["type"] for event in events],
+            ["typing", "stop_typing"],
+        )
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel_name), 0.05)
+
+    def test_typing_is_throttled_across_connections(self):
+        async_to_sync(self.check_throttle_across_connections)()
+
+    async def check_throttle_across_connections(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("chat_chat", channel_name)
+        first = typing.TypingIndicator(channel_layer, "user")
+        second = typing.TypingIndicator(channel_layer, "user")
+        other = typing.TypingIndicator(channel_layer, "other_user")
+
+        await first.typing("chat")
+        await second.typing("chat")
+        await other.typing("chat")
+
+        events = [await channel_layer.receive(channel_name) for _ in range(2)]
+        self.assertEqual([event["user_id"] for event in events], ["user", "other_user"])
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel_name), 0.05)
+        self.assertIn(typing.KEY % ("chat", "user"), self.keys)
+
+        await first.stop_typing("chat")
+        self.assertNotIn(typing.KEY % ("chat", "user"), self.keys)
+        await second.stop_all()
+        await other.stop_all()
+
+    def test_throttles_per_connection_when_redis_is_down(self):
+        typing.async_redis_client.set.side_effect = OSError
+        async_to_sync(self.check_coalescing)()
+
+    @mock.patch("chats.typing.TTL", 0.01)
+    def test_typing_expires_without_stop_typing(self):
+        async_to_sync(self.check_expiry)()
+
+    async def check_expiry(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("chat_chat", channel_name)
+        indicator = typing.TypingIndicator(channel_layer, "user")
+
+        await indicator.typing("chat")
+        await asyncio.sleep(0.05)
+
+        events = [await channel_layer.receive(channel_name) for _ in range(2)]
+        self.assertEqual(json.loads(events[1]["frame"])["type"], "stop_typing")
+        self.assertEqual(indicator._expiry_tasks, {})
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@mock.patch("chats.receipts.FLUSH_INTERVAL", 0.01)
+class ReadReceiptBufferTests(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.other_user = create_user(1)
+        self.chat, _ = Chat.get_or_create_direct(self.user, self.other_user)
+        self.messages = []
+        for index in range(20):
+            self.messages.append(
+                Message.objects.create(
+                    chat=self.chat, sender=self.other_user, text="m%s" % index
+                )
+            )
+            Message.objects.filter(id=self.messages[-1].id).update(
+                created_at=datetime.datetime(
+                    2024, 1, 1, 0, 0, index, tzinfo=datetime.timezone.utc
+                )
+            )
+
+    def test_reads_are_flushed_as_one_watermark_move(self):
+        with mock.patch.object(
+            ChatParticipant,
+            "mark_read",
+            autospec=True,
+            side_effect=ChatParticipant.mark_read,
+        ) as mark_read:
+            event = async_to_sync(self.read_messages)(self.messages)
+
+        mark_read.assert_called_once()
+        participant = self.chat.members.get(user=self.user)
+        self.assertEqual(participant.last_read_message, self.messages[-1])
+        self.assertEqual(participant.inbox_entry.unread_count, 0)
+        frame = json.loads(event["frame"])
+        self.assertEqual(frame["message_id"], str(self.messages[-1].id))
+        self.assertEqual(frame["user_id"], str(self.user.id))
+
+    def test_older_reads_do_not_broadcast(self):
+        async_to_sync(self.read_messages)(self.messages[5:6])
+
+        event = async_to_sync(self.read_messages)(self.messages[:5] + ["bad id"])
+
+        self.assertIsNone(event)
+        participant = self.chat.members.get(user=self.user)
+        self.assertEqual(participant.last_read_message, self.messages[5])
+
+    async def read_messages(self, messages):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("chat_%s" % self.chat.id, channel_name)
+        buffer = receipts.ReadReceiptBuffer(channel_layer, self.user.id)
+
+        for message in reversed(messages):
+            await buffer.read(self.chat.id, getattr(message, "id", message))
+        await asyncio.sleep(0.1)
+
+        try:
+            return await asyncio.wait_for(channel_layer.receive(channel_name), 0.05)
+        except asyncio.TimeoutError:
+            return None
+
+
+class ClientMessageIdTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.chat, _ = Chat.get_or_create_direct(self.user, create_user(1))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def send(self, **data):
+        return self.client.post(
+            reverse("chats:chat-messages-list"),
+            {"chat": str(self.chat.id), "text": "hi", **data},
+            format="json",
+        )
+
+    def test_retry_returns_the_original_message(self):
+        first = self.send(client_message_id="local-1")
+        retry = self.send(client_message_id="local-1")
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data["id"], first.data["id"])
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(MessageOutbox.objects.count(), 1)
+
+    def test_retry_is_answered_from_redis(self):
+        message = Message.objects.create(
+            chat=self.chat, sender=self.user, text="hi", client_message_id="local-1"
+        )
+
+        with mock.patch("chats.idempotency.redis_client") as redis_client:
+            redis_client.get.return_value = str(message.id).encode()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.send(client_message_id="local-1")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["id"], str(message.id))
+        self.assertFalse(
+            [query for query in queries if query["sql"].startswith("INSERT")]
+        )
+
+    def test_messages_without_client_id_are_not_deduplicated(self):
+        self.assertEqual(self.send().status_code, 201)
+        self.assertEqual(self.send().status_code, 201)
+        self.assertEqual(Message.objects.count(), 2)
+
+    @mock.patch("chats.idempotency.remember")
+    def test_client_id_is_remembered_on_commit(self, remember):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(client_message_id="local-1")
+
+        remember.assert_called_once_with(Message.objects.get())
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@mock.patch("chats.presence.get_online_users", return_value=set())
+@mock.patch("chats.presence.get_active_users_in_chat", return_value=set())
+class BulkMessageTests(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.other_user = create_user(1)
+        self.chat, _ = Chat.get_or_create_direct(self.user, self.other_user)
+        self.group = Chat.objects.create(type=Chat.ChatTypes.group)
+        self.group.members.create(user=self.user)
+        self.group.members.create(user=self.other_user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def send(self, messages):
+        return self.client.post(
+            reverse("chats:chat-messages-bulk"), {"messages": messages}, format="json"
+        )
+
+    def test_messages_are_inserted_and_broadcast_once_per_chat(self, *mocks):
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)("chat_%s" % self.chat.id, channel_name)
+        messages = [{"chat_id": str(self.chat.id), "text": "m%s" % i} for i in range(5)]
+        messages.append({"chat_id": str(self.group.id), "text": "group"})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.send(messages)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 6)
+        inserts = [
+            query
+            for query in queries
+            if query["sql"].startswith('INSERT INTO "chats_message"')
+        ]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(MessageOutbox.objects.values("batch_id").distinct().count(), 1)
+        self.assertEqual(MessageOutbox.objects.count(), 6)
+        self.assertEqual(
+            ChatEvent.objects.filter(kind=ChatEvent.Kinds.message_created).count(), 6
+        )
+
+        call_command("dispatch_outbox", "--once", stdout=StringIO())
+
+        self.assertFalse(MessageOutbox.objects.exists())
+        event = async_to_sync(channel_layer.receive)(channel_name)
+        frame = json.loads(event["frame"])
+        self.assertEqual(
+            [m["text"] for m in frame["messages"]], ["m%s" % i for i in range(5)]
+        )
+
+        entry = self.chat.inbox_entries.get(user=self.other_user)
+        self.assertEqual(entry.unread_count, 5)
+        self.assertEqual(entry.last_message.text, "m4")
+
+    def test_concurrent_retry_returns_the_committed_messages(self, *mocks):
+        # Another request with the same client message id commits between
+        # this one's lookup and its insert.
+        committed = Message.objects.create(
+            chat=self.chat, sender=self.user, text="hi", client_message_id="a"
+        )
+        select_related = Message.objects.select_related
+        lookups = []
+
+        def missing_first_lookup(*fields):
+            lookups.append(fields)
+            if len(lookups) == 1:
+                return Message.objects.none()
+            return select_related(*fields)
+
+        with mock.patch.object(Message.objects, "select_related", missing_first_lookup):
+            response = self.send(
+                [{"chat_id": str(self.chat.id), "text": "hi", "client_message_id": "a"}]
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data[0]["id"], str(committed.id))
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_chats_the_user_is_not_in_are_rejected(self, *mocks):
+        chat, _ = Chat.get_or_create_direct(self.other_user, create_user(2))
+
+        response = self.send(
+            [
+                {"chat_id": str(self.chat.id), "text": "hi"},
+                {"chat_id": str(chat.id), "text": "hi"},
+            ]
+        )
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Message.objects.exists())
+
+    def test_unregistered_users_are_rejected(self, *mocks):
+        self.user.name = ""
+        self.user.save()
+
+        response = self.send([{"chat_id": str(self.chat.id), "text": "hi"}])
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Message.objects.exists())
+
+    def test_retried_client_message_ids_are_not_sent_again(self, *mocks):
+        messages = [
+            {"chat_id": str(self.chat.id), "text": "hi", "client_message_id": "a"},
+            {"chat_id": str(self.chat.id), "text": "hi", "client_message_id": "a"},
+        ]
+
+        first = self.send(messages)
+        retry = self.send(messages + [{"chat_id": str(self.chat.id), "text": "new"}])
+
+        self.assertEqual(first.data[0]["id"], first.data[1]["id"])
+        self.assertEqual(retry.data[0]["id"], first.data[0]["id"])
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(
+            self.chat.inbox_entries.get(user=self.other_user).unread_count, 2
+        )
+
+
+class ChatSyncTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.other_user = create_user(1)
+        self.chat, _ = Chat.get_or_create_direct(self.user, self.other_user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, **params):
+        response = self.client.get(reverse("chats:chat-sync"), params)
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            return json.loads(read_streaming_content(response))
+        return response.json()
+
+    def test_returns_changes_since_the_cursor(self):
+        cursor = self.sync()["cursor"]
+        kept = Message.objects.create(chat=self.chat, sender=self.other_user, text="a")
+        deleted = Message.objects.create(chat=self.chat, sender=self.user, text="b")
+        deleted_id = str(deleted.id)
+        kept.text = "edited"
+        kept.save()
+        deleted.delete()
+        group = Chat.objects.create(type=Chat.ChatTypes.group)
+        group.members.create(user=self.user)
+        unrelated, _ = Chat.get_or_create_direct(self.other_user, create_user(2))
+        Message.objects.create(chat=unrelated, sender=self.other_user, text="c")
+
+        data = self.sync(cursor=cursor)
+
+        self.assertEqual(
+            [(event["type"], event["message_id"]) for event in data["events"]],
+            [
+                ("message.created", str(kept.id)),
+                ("message.created", deleted_id),
+                ("message.updated", str(kept.id)),
+                ("message.deleted", deleted_id),
+                ("member.joined", None),
+            ],
+        )
+        self.assertEqual(data["events"][0]["message"]["text"], "edited")
+        self.assertIsNone(data["events"][1]["message"])
+        self.assertEqual(data["events"][4]["chat_id"], str(group.id))
+        self.assertFalse(data["has_more"])
+        self.assertEqual(self.sync(cursor=data["cursor"])["events"], [])
+
+    def test_soft_deleted_messages_are_not_synced(self):
+        cursor = self.sync()["cursor"]
+        message = Message.objects.create(
+            chat=self.chat, sender=self.other_user, text="secret"
+        )
+        message.is_deleted = True
+        message.save()
+
+        data = self.sync(cursor=cursor)
+
+        self.assertEqual(
+            [(event["type"], event["message"]) for event in data["events"]],
+            [("message.created", None), ("message.deleted", None)],
+        )
+        self.assertNotIn(b"secret", json.dumps(data).encode())
+
+    def test_former_members_only_sync_up_to_their_departure(self):
+        cursor = self.sync()["cursor"]
+        participant = self.chat.members.get(user=self.user)
+        participant.left_at = datetime.datetime.now(datetime.timezone.utc)
+        participant.save()
+        Message.objects.create(chat=self.chat, sender=self.other_user, text="later")
+
+        data = self.sync(cursor=cursor)
+
+        self.assertEqual([event["type"] for event in data["events"]], ["member.left"])
+        response = self.client.get(
+            reverse("chats:chat-messages", kwargs={"chat_id": self.chat.id})
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_removed_members_see_their_removal(self):
+        cursor = self.sync()["cursor"]
+        self.chat.members.get(user=self.user).delete()
+        Message.objects.create(chat=self.chat, sender=self.other_user, text="later")
+
+        data = self.sync(cursor=cursor)
+
+        self.assertEqual(
+            [event["type"] for event in data["events"]], ["member.removed"]
+        )
+
+    def test_rejoined_chats_are_synced_once(self):
+        cursor = self.sync()["cursor"]
+        participant = self.chat.members.get(user=self.user)
+        participant.left_at = datetime.datetime.now(datetime.timezone.utc)
+        participant.save()
+        participant.left_at = None
+        participant.save()
+        message = Message.objects.create(chat=self.chat, sender=self.user, text="hi")
+
+        data = self.sync(cursor=cursor)
+
+        self.assertEqual(
+            [(event["type"], event["message_id"]) for event in data["events"]],
+            [("member.left", None), ("message.created", str(message.id))],
+        )
+
+    def test_pages_through_changes(self):
+        cursor = self.sync()["cursor"]
+        for index in range(5):
+            Message.objects.create(chat=self.chat, sender=self.user, text=str(index))
+
+        texts = []
+        while True:
+            data = self.sync(cursor=cursor, page_size=2)
+            texts += [event["message"]["text"] for event in data["events"]]
+            cursor = data["cursor"]
+            if not data["has_more"]:
+                break
+
+        self.assertEqual(texts, ["0", "1", "2", "3", "4"])
+
+    def test_query_count_does_not_grow_with_the_number_of_chats(self):
+        for index in range(2, 12):
+            Chat.get_or_create_direct(self.user, create_user(index))
+        cursor = ChatEvent.objects.order_by("-id").first().id
+        Message.objects.create(chat=self.chat, sender=self.user, text="hi")
+
+        with CaptureQueriesContext(connection) as queries:
+            data = self.sync(cursor=cursor)
+
+        self.assertEqual(len(data["events"]), 1)
+        self.assertLessEqual(len(queries), 4)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("chats:chat-sync"), {"cursor": "abc"})
+        self.assertEqual(response.status_code, 400)
+
+
+@mock.patch("chats.export.CHUNK_SIZE", 3)
+class ChatExportTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.other_user = create_user(1)
+        self.chat, _ = Chat.get_or_create_direct(self.user, self.other_user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_streams_history_as_ndjson_in_chunks(self):
+        for index in range(7):
+            Message.objects.create(
+                chat=self.chat,
+                sender=[self.user, self.other_user][index % 2],
+                text=str(index),
+            )
+        Message.objects.create(
+            chat=self.chat, sender=self.user, text="gone", is_deleted=True
+        )
+        media_message = Message.objects.get(text="6")
+        MessageMedia.objects.create(
+            message=media_message, type="Image", file="messages/media/a.png"
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse("chats:chat-export", kwargs={"chat_id": self.chat.id})
+            )
+            lines = read_streaming_content(response).splitlines()
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        messages = [json.loads(line) for line in lines]
+        self.assertEqual([m["text"] for m in messages], [str(i) for i in range(7)])
+        self.assertEqual(messages[1]["sender"]["name"], "user 1")
+        self.assertNotIn("phone_number", messages[1]["sender"])
+        self.assertEqual(len(messages[6]["media"]), 1)
+        self.assertIn("a.png", messages[6]["media"][0]["url"])
+        media_queries = [
+            query for query in queries if "chats_messagemedia" in query["sql"]
+        ]
+        self.assertEqual(len(media_queries), 3)
+
+    def test_only_members_can_export(self):
+        chat, _ = Chat.get_or_create_direct(self.other_user, create_user(2))
+
+        response = self.client.get(
+            reverse("chats:chat-export", kwargs={"chat_id": chat.id})
+        )
+
+        self.assertEqual(response.status_code, 404)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.other_user = create_user(1)
+        self.chat, _ = Chat.get_or_create_direct(self.user, self.other_user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        response = self.client.get(reverse("chats:chat-search"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_ranks_and_highlights_matches_in_the_users_chats(self):
+        best = Message.objects.create(
+            chat=self.chat, sender=self.other_user, text="lunch? lunch at noon, lunch"
+        )
+        Message.objects.create(
+            chat=self.chat, sender=self.user, text="what about lunch tomorrow then"
+        )
+        Message.objects.create(chat=self.chat, sender=self.user, text="no match here")
+        other_chat, _ = Chat.get_or_create_direct(self.other_user, create_user(2))
+        Message.objects.create(chat=other_chat, sender=self.other_user, text="lunch")
+
+        results = self.search(q="lunch")["results"]
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]["id"], str(best.id))
+        self.assertGreater(results[0]["rank"], results[1]["rank"])
+        self.assertIn("<mark>lunch</mark>", results[0]["snippet"])
+        self.assertNotIn("search_vector", results[0])
+
+    def test_snippets_escape_the_message_text(self):
+        Message.objects.create(
+            chat=self.chat, sender=self.user, text="<script>alert(1)</script> lunch"
+        )
+
+        snippet = self.search(q="lunch")["results"][0]["snippet"]
+
+        self.assertNotIn("<script>", snippet)
+        self.assertIn("&lt;script&gt;", snippet)
+        self.assertIn("<mark>lunch</mark>", snippet)
+
+    def test_rebuild_command_indexes_existing_messages(self):
+        message = Message.objects.create(chat=self.chat, sender=self.user, text="memo")
+        Message.objects.update(search_vector=None)
+        search.unindex_messages([message.id])
+        self.assertEqual(self.search(q="memo")["results"], [])
+
+        call_command("rebuild_search_index", stdout=StringIO())
+
+        self.assertEqual(self.search(q="memo")["results"][0]["id"], str(message.id))
+
+    def test_invalid_cursor_is_not_found(self):
+        for position in ("1.0|notauuid", "notarank|%s" % uuid.uuid4(), "1.0"):
+            response = self.client.get(
+                reverse("chats:chat-search"),
+                {"q": "lunch", "before": b64encode(position.encode()).decode()},
+            )
+            self.assertEqual(response.status_code, 404)
+
+    def test_bulk_sends_are_indexed(self):
+        with transaction.atomic():
+            Message.bulk_send(self.user, [{"chat_id": self.chat.id, "text": "memo"}])
+
+        self.assertEqual(len(self.search(q="memo")["results"]), 1)
+
+    def test_edits_and_deletes_update_the_index(self):
+        message = Message.objects.create(chat=self.chat, sender=self.user, text="old")
+        message.text = "new words"
+        message.save()
+        self.assertEqual(self.search(q="old")["results"], [])
+        self.assertEqual(len(self.search(q="words")["results"]), 1)
+
+        message.is_deleted = True
+        message.save()
+        self.assertEqual(self.search(q="words")["results"], [])
+
+    def test_pages_through_results_with_a_cursor(self):
+        for index in range(5):
+            Message.objects.create(
+                chat=self.chat, sender=self.user, text="report " * (index + 1)
+            )
+
+        ids = []
+        params = {"q": "report", "page_size": 2}
+        while True:
+            data = self.search(**params)
+            ids += [result["id"] for result in data["results"]]
+            if not data["cursors"]["before"]:
+                break
+            params["before"] = data["cursors"]["before"]
+
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 5)
+
+    def test_query_syntax_is_not_interpreted(self):
+        Message.objects.create(chat=self.chat, sender=self.user, text="a AND b")
+
+        self.assertEqual(len(self.search(q='"a" AND (b')["results"]), 1)
+
+    def test_query_is_required(self):
+        response = self.client.get(reverse("chats:chat-search"))
+        self.assertEqual(response.status_code, 400)
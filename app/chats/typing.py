@@ -0,0 +1,104 @@
+"""
+Typing indicators, sent through the channel layer only and never stored.
+
+A user's typing in a chat is broadcast at most once every
+`BROADCAST_INTERVAL` seconds, however many `typing` frames the client sends
+and however many connections the user has open. The throttle is a
+`typing:<chat_id>:<user_id>` key in Redis set with NX and an expiry; when
+Redis is down each connection throttles on its own. The indicator stops on
+`stop_typing`, when the connection leaves the chat, or by itself `TTL`
+seconds after the last `typing` frame.
+"""
+
+import asyncio
+import time
+
+from core import fastjson
+
+from .utils import async_redis_client
+
+KEY = "typing:%s:%s"
+
+BROADCAST_INTERVAL = 3
+TTL = 6
+
+
+def encode_typing_frame(type, chat_id, user_id):
+    return fastjson.dumps_text(
+        {"type": type, "chat_id": str(chat_id), "user_id": str(user_id)}
+    )
+
+
+class TypingIndicator:
+    """
+    Typing state of one websocket connection, per chat.
+    """
+
+    def __init__(self, channel_layer, user_id):
+        self.channel_layer = channel_layer
+        self.user_id = user_id
+        self._broadcast_at = {}
+        self._expires_at = {}
+        self._expiry_tasks = {}
+
+    async def _broadcast(self, type, chat_id):
+        await self.channel_layer.group_send(
+            "chat_%s" % chat_id,
+            {
+                "type": "typing_indicator",
+                "user_id": str(self.user_id),
+                "frame": encode_typing_frame(type, chat_id, self.user_id),
+            },
+        )
+
+    async def _expire(self, chat_id):
+        while True:
+            delay = self._expires_at[chat_id] - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        self._expiry_tasks.pop(chat_id, None)
+        await self._stop(chat_id)
+
+    async def _stop(self, chat_id):
+        self._expires_at.pop(chat_id, None)
+        if self._broadcast_at.pop(chat_id, None) is not None:
+            try:
+                await async_redis_client.delete(KEY % (chat_id, self.user_id))
+            except Exception as e:
+                print(f"Error deleting typing throttle from redis: {e}")
+            await self._broadcast("stop_typing", chat_id)
+
+    async def _should_broadcast(self, chat_id, now):
+        try:
+            return bool(
+                await async_redis_client.set(
+                    KEY % (chat_id, self.user_id), 1, nx=True, ex=BROADCAST_INTERVAL
+                )
+            )
+        except Exception as e:
+            print(f"Error writing typing throttle to redis: {e}")
+        broadcast_at = self._broadcast_at.get(chat_id)
+        return broadcast_at is None or broadcast_at + BROADCAST_INTERVAL <= now
+
+    async def typing(self, chat_id):
+        now = time.monotonic()
+        self._expires_at[chat_id] = now + TTL
+        if chat_id not in self._expiry_tasks:
+            self._expiry_tasks[chat_id] = asyncio.ensure_future(self._expire(chat_id))
+
+        if not await self._should_broadcast(chat_id, now):
+            return
+        self._broadcast_at[chat_id] = now
+        await self._broadcast("typing", chat_id)
+
+    async def stop_typing(self, chat_id):
+        task = self._expiry_tasks.pop(chat_id, None)
+        if task:
+            task.cancel()
+        await self._stop(chat_id)
+
+    async def stop_all(self):
+        for chat_id in list(self._expires_at):
+            await self.stop_typing(chat_id)
@@ -1,15 +1,31 @@
 from django.contrib.auth import get_user_model
-from django.db.models import Count
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, UUIDField
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 
-from rest_framework import viewsets
+from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
+from core.pagination import KeysetPagination, SearchPagination
+from core.permissions import IsAuthenticationAndRegistered
+
+from . import idempotency, membership, search, sync
+from .export import stream_chat_export
 from .permissions import IsChatMember
-from .models import Chat, Message
-from .serializers import ChatSerializer, CreatePrivateChatSerializer, MessageSerializer
+from .models import Chat, ChatEvent, ChatParticipant, InboxEntry, Message
+from .serializers import (
+    BulkMessageSerializer,
+    ChatSerializer,
+    CreatePrivateChatSerializer,
+    InboxSerializer,
+    MessageCursorSerializer,
+    MessageSerializer,
+    SearchResultSerializer,
+)
 
 # Create your views here.
 
@@ -22,14 +38,37 @@ class ChatViewset(viewsets.ModelViewSet):
     lookup_url_kwarg = "chat_id"
     serializer_class = ChatSerializer
 
+    def get_serializer_class(self):
+        if self.action == "list":
+            return InboxSerializer
+        return super().get_serializer_class()
+
     def get_queryset(self):
-        if self.request.user.is_authenticated:
+        if self.action == "list" and self.request.user.is_authenticated:
             return (
+                InboxEntry.objects.filter(user=self.request.user)
+                .select_related("chat", "last_message")
+                .order_by("-last_activity_at")
+            )
+
+        if self.request.user.is_authenticated:
+            chats = (
                 super()
                 .get_queryset()
-                .filter(members__user=self.request.user)
+                .filter(members__user=self.request.user, members__left_at__isnull=True)
                 .order_by("-created_at")
             )
+            if self.action == "retrieve":
+                # Saves ChatSerializer a query for the other direct participant.
+                other_member = ChatParticipant.objects.filter(
+                    chat=OuterRef("pk")
+                ).exclude(user=self.request.user)
+                chats = chats.annotate(
+                    other_user_id=Subquery(
+                        other_member.values("user_id")[:1], output_field=UUIDField()
+                    )
+                )
+            return chats
 
     @action(
         detail=False,
@@ -43,16 +82,7 @@ class ChatViewset(viewsets.ModelViewSet):
         user_id = serializer.validated_data.get("user_id")
         user = get_object_or_404(get_user_model(), id=user_id)
 
-        chat = (
-            Chat.objects.filter(members__user__in=[request.user, user])
-            .annotate(member_count=Count("members"))
-            .filter(member_count=2)
-            .first()
-        )
-        if not chat:
-            chat = Chat.objects.create(type=Chat.ChatTypes.individual)
-            chat.members.create(user=request.user)
-            chat.members.create(user=user)
+        chat, _ = Chat.get_or_create_direct(request.user, user)
 
         return Response(
             {
@@ -61,6 +91,144 @@ class ChatViewset(viewsets.ModelViewSet):
             }
         )
 
+    def _advance_cursor(self, request, mark):
+        chat = self.get_object()
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        message = get_object_or_404(
+            Message, id=serializer.validated_data["message_id"], chat=chat
+        )
+        participant = get_object_or_404(ChatParticipant, chat=chat, user=request.user)
+        mark(participant, message)
+        return participant
+
+    @action(
+        detail=True,
+        methods=["post"],
+        url_path="delivered",
+        serializer_class=MessageCursorSerializer,
+    )
+    def mark_delivered(self, request, chat_id=None):
+        self._advance_cursor(request, ChatParticipant.mark_delivered)
+        return Response({"message": "Delivery cursor updated successfully"})
+
+    @action(
+        detail=True,
+        methods=["post"],
+        url_path="read",
+        serializer_class=MessageCursorSerializer,
+    )
+    def mark_read(self, request, chat_id=None):
+        participant = self._advance_cursor(request, ChatParticipant.mark_read)
+        return Response(
+            {
+                "data": {"unread_count": participant.unread_messages().count()},
+                "message": "Read cursor updated successfully",
+            }
+        )
+
+    @action(
+        detail=True,
+        methods=["get"],
+        url_path="messages",
+        serializer_class=MessageSerializer,
+        pagination_class=KeysetPagination,
+    )
+    def messages(self, request, chat_id=None):
+        chat = self.get_object()
+        queryset = chat.messages.filter(is_deleted=False).select_related("chat")
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(
+        detail=True,
+        methods=["get"],
+        url_path=r"messages/(?P<message_id>[0-9a-f-]+)/receipts",
+    )
+    def receipts(self, request, chat_id=None, message_id=None):
+        chat = self.get_object()
+        message = get_object_or_404(Message, id=message_id, chat=chat)
+        return Response(
+            {
+                "data": message.receipt_counts(),
+                "message": "Message receipts retrieved successfully",
+            }
+        )
+
+    @action(detail=True, methods=["get"])
+    def export(self, request, chat_id=None):
+        """
+        Streams the chat's whole history as NDJSON, one message per line.
+        """
+        chat = self.get_object()
+        response = StreamingHttpResponse(
+            stream_chat_export(chat), content_type="application/x-ndjson"
+        )
+        response["Content-Disposition"] = (
+            'attachment; filename="chat-%s.ndjson"' % chat.id
+        )
+        return response
+
+    @action(
+        detail=False,
+        methods=["get"],
+        serializer_class=SearchResultSerializer,
+        pagination_class=SearchPagination,
+    )
+    def search(self, request):
+        """
+        Searches the text of the messages in the user's chats for `q`, best
+        match first, with the matching words highlighted in `snippet`.
+        """
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            raise ValidationError({"q": "This query parameter is required."})
+
+        chat_ids = membership.get_chat_ids(request.user.id)
+        page = self.paginate_queryset(
+            lambda before, limit: search.search_messages(query, chat_ids, before, limit)
+        )
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=["get"])
+    def sync(self, request):
+        """
+        Streams what changed in the user's chats since `cursor`: new, edited
+        and deleted messages and members joining and leaving. Pass the
+        returned cursor back while `has_more` is true. Without a cursor only
+        the current one is returned, to start syncing from.
+        """
+        cursor = request.query_params.get("cursor")
+        if cursor is None:
+            # Ids are global, so the newest event of any chat is a valid
+            # starting cursor.
+            last_event = (
+                ChatEvent.objects.order_by("-id").values_list("id", flat=True).first()
+            )
+            return Response(
+                {"events": [], "cursor": str(last_event or 0), "has_more": False}
+            )
+
+        try:
+            cursor = int(cursor)
+            page_size = min(
+                int(request.query_params.get("page_size", sync.PAGE_SIZE)),
+                sync.MAX_PAGE_SIZE,
+            )
+        except ValueError:
+            raise ValidationError("Invalid cursor or page size.")
+        if cursor < 0 or page_size < 1:
+            raise ValidationError("Invalid cursor or page size.")
+
+        return StreamingHttpResponse(
+            sync.stream_events(
+                ChatEvent.for_user(request.user, after=cursor), cursor, page_size
+            ),
+            content_type="application/json",
+        )
+
 
 class ChatMessageViewset(viewsets.ModelViewSet):
     queryset = Message.objects.all()
@@ -71,4 +239,44 @@ class ChatMessageViewset(viewsets.ModelViewSet):
     def get_permissions(self):
         if self.action == "create":
             return [IsChatMember()]
+        if self.action == "bulk":
+            # Membership of every chat in the batch is checked in `bulk`.
+            return [IsAuthenticationAndRegistered()]
         return super().get_permissions()
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        message, created = idempotency.save_message(serializer)
+        return Response(
+            self.get_serializer(message).data,
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """
+        Sends up to `MAX_BULK_MESSAGES` messages across one or more chats in
+        one insert. The outbox dispatcher broadcasts them as one event per
+        chat.
+        """
+        serializer = BulkMessageSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data["messages"]
+
+        chat_ids = {str(item["chat_id"]) for item in items}
+        if chat_ids - membership.get_chat_ids(request.user.id):
+            raise PermissionDenied(IsChatMember.message)
+
+        # The messages and their outbox entries are committed together.
+        with transaction.atomic():
+            messages, created = Message.bulk_send(request.user, items)
+
+        for message in created:
+            if message.client_message_id:
+                idempotency.remember(message)
+
+        return Response(
+            MessageSerializer(messages, many=True).data,
+            status=status.HTTP_201_CREATED,
+        )
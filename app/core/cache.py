@@ -0,0 +1,75 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+GENERATION_KEY = "generation:%s"
+# Longer than any entry written under a generation lives, so a generation
+# that expires never brings an entry of an older one back.
+GENERATION_TIMEOUT = 60 * 60 * 24
+
+
+class LocalCache:
+    """
+    Thread safe, size bounded LRU whose entries expire after `timeout` seconds.
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def get_generations(keys):
+    """
+    Returns the current generation of each of the given cache keys, 0 for
+    keys that were never bumped.
+    """
+    generations = cache.get_many([GENERATION_KEY % key for key in keys])
+    return {key: generations.get(GENERATION_KEY % key, 0) for key in keys}
+
+
+def versioned_key(key, generation):
+    return "%s:%s" % (key, generation)
+
+
+def bump_generation(key):
+    """
+    Moves a cache key to its next generation. Entries written under an
+    older one, including fills that loaded from the database before the
+    bump, are never read again.
+    """
+    generation_key = GENERATION_KEY % key
+    cache.add(generation_key, 0, GENERATION_TIMEOUT)
+    cache.incr(generation_key)
+    cache.touch(generation_key, GENERATION_TIMEOUT)
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+from collections import defaultdict
+
+from channels_redis.core import RedisChannelLayer
+
+# Same script channels_redis runs for a single group_send.
+GROUP_SEND_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+class BulkRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that can send one event to many groups at once.
+    """
+
+    async def group_send_many(self, groups, message):
+        """
+        Sends the message to every channel of every group. The group lookups
+        are pipelined and the sends batched into one script call per Redis
+        host, instead of several round trips per group.
+        """
+        groups = set(groups)
+        for group in groups:
+            assert self.require_valid_group_name(group), "Group name not valid"
+
+        groups_by_connection = defaultdict(list)
+        for group in groups:
+            groups_by_connection[self.consistent_hash(group)].append(group)
+
+        channel_names = set()
+        group_expired_at = int(time.time()) - self.group_expiry
+        for connection_index, connection_groups in groups_by_connection.items():
+            pipeline = self.connection(connection_index).pipeline(transaction=False)
+            for group in connection_groups:
+                key = self._group_key(group)
+                pipeline.zremrangebyscore(key, min=0, max=group_expired_at)
+                pipeline.zrange(key, 0, -1)
+            results = await pipeline.execute()
+            for names in results[1::2]:
+                channel_names.update(name.decode("utf8") for name in names)
+
+        if not channel_names:
+            return
+
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channel_names, message)
+
+        message_expired_at = int(time.time()) - int(self.expiry)
+        for connection_index, channel_redis_keys in connection_to_channel_keys.items():
+            connection = self.connection(connection_index)
+            pipeline = connection.pipeline(transaction=False)
+            for key in channel_redis_keys:
+                pipeline.zremrangebyscore(key, min=0, max=message_expired_at)
+            await pipeline.execute()
+
+            args = [channel_keys_to_message[key] for key in channel_redis_keys]
+            args += [channel_keys_to_capacity[key] for key in channel_redis_keys]
+            args += [time.time(), self.expiry]
+            await connection.eval(
+                GROUP_SEND_LUA, len(channel_redis_keys), *channel_redis_keys, *args
+            )
+
+
+async def group_send_many(channel_layer, groups, message):
+    """
+    Sends the message to many groups, in bulk when the channel layer
+    supports it.
+    """
+    if hasattr(channel_layer, "group_send_many"):
+        await channel_layer.group_send_many(groups, message)
+    else:
+        await asyncio.gather(
+            *(channel_layer.group_send(group, message) for group in groups)
+        )
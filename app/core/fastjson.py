@@ -0,0 +1,63 @@
+"""
+JSON encoding shared by the REST renderer, parser and websocket consumers.
+Uses orjson when it is installed and falls back to the standard library.
+"""
+
+import json
+
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.functional import Promise
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(obj):
+    # orjson handles UUIDs, datetimes, dataclasses and str/dict/list
+    # subclasses natively; this covers the rest of what DRF emits.
+    if isinstance(obj, (Decimal, Promise)):
+        return str(obj)
+    if hasattr(obj, "__iter__"):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson:
+    OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+    def dumps(obj):
+        """
+        Encodes obj to JSON bytes.
+        """
+        return orjson.dumps(obj, default=_default, option=OPTIONS)
+
+    def loads(data):
+        return orjson.loads(data)
+
+    DecodeError = orjson.JSONDecodeError
+
+else:  # pragma: no cover
+
+    def dumps(obj):
+        """
+        Encodes obj to JSON bytes.
+        """
+        return json.dumps(
+            obj, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(",", ":")
+        ).encode()
+
+    def loads(data):
+        return json.loads(data)
+
+    DecodeError = json.JSONDecodeError
+
+
+def dumps_text(obj):
+    """
+    Encodes obj to a JSON string, for websocket text frames.
+    """
+    return dumps(obj).decode()
@@ -1,27 +1,28 @@
 # websocket_middleware.py
 from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from django.contrib.auth import get_user_model
 from urllib.parse import parse_qs
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 
-User = get_user_model()
+from users import user_cache
 
 
-@database_sync_to_async
-def get_user_from_jwt(token_string):
+async def get_user_from_jwt(token_string):
     try:
         # Validate the JWT token
         access_token = AccessToken(token_string)
         user_id = access_token["user_id"]
-        user = User.objects.get(id=user_id)
-        return user
-    except (InvalidToken, TokenError, User.DoesNotExist) as e:
+    except (InvalidToken, TokenError) as e:
         print(f"JWT Auth failed: {e}")
         return AnonymousUser()
 
+    user = await user_cache.aget_user(user_id)
+    if user is None or not user.is_active:
+        print(f"JWT Auth failed: no active user {user_id}")
+        return AnonymousUser()
+    return user
+
 
 class JWTAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
@@ -1,14 +1,170 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+import uuid
+
+from base64 import b64decode, b64encode
+from hashlib import md5
+
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db import connection
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 DEFAULT_PAGE = 1
 
+COUNT_EXACT = "exact"
+COUNT_ESTIMATE = "estimate"
+COUNT_NONE = "none"
+
+# Planner estimates below this are too rough to use, so small results are
+# still counted exactly.
+ESTIMATE_COUNT_THRESHOLD = 10000
+ESTIMATE_COUNT_TIMEOUT = 60
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator whose total comes from `estimate_count`, so pages past the
+    estimate are still served instead of raising EmptyPage.
+    """
+
+    @cached_property
+    def count(self):
+        return estimate_count(self.object_list)
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger("That page number is not an integer")
+        if number < 1:
+            raise EmptyPage("That page number is less than 1")
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        return self._get_page(
+            self.object_list[bottom : bottom + self.per_page], number, self
+        )
+
+
+def estimate_count(queryset):
+    """
+    Returns a cached row count for the queryset. On Postgres, large results
+    are counted from the query planner's estimate instead of a COUNT(*).
+    """
+    sql, params = queryset.query.sql_with_params()
+    cache_key = "pagination:count:%s" % md5(f"{sql}{params}".encode()).hexdigest()
+    count = cache.get(cache_key)
+    if count is not None:
+        return count
+
+    count = None
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        count = int(plan[0]["Plan"]["Plan Rows"])
+        if count < ESTIMATE_COUNT_THRESHOLD:
+            count = None
+    if count is None:
+        count = queryset.count()
+
+    cache.set(cache_key, count, ESTIMATE_COUNT_TIMEOUT)
+    return count
+
 
 class CustomPagination(PageNumberPagination):
+    """
+    Page number pagination with opt-in count modes, selected with `?count=`:
+
+    - `exact` (default): runs COUNT(*) for `pages` and `total`.
+    - `estimate`: `pages` and `total` come from `estimate_count`.
+    - `none`: no count at all, `has_next` is found by fetching one extra row.
+    """
+
     page_size_query_param = "page_size"
     max_page_size = 100
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_mode = request.query_params.get(self.count_query_param, COUNT_EXACT)
+
+        if self.count_mode == COUNT_NONE:
+            return self.paginate_queryset_without_count(queryset, request)
+
+        if self.count_mode == COUNT_ESTIMATE:
+            self.django_paginator_class = EstimatedCountPaginator
+        else:
+            self.count_mode = COUNT_EXACT
+        return super().paginate_queryset(queryset, request, view)
+
+    def paginate_queryset_without_count(self, queryset, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        try:
+            self.page_number = int(request.query_params.get(self.page_query_param, 1))
+        except ValueError:
+            self.page_number = 0
+        if self.page_number < 1:
+            raise NotFound(
+                self.invalid_page_message.format(
+                    page_number=self.page_number, message="Invalid page."
+                )
+            )
+
+        offset = (self.page_number - 1) * page_size
+        results = list(queryset[offset : offset + page_size + 1])
+        self.has_next = len(results) > page_size
+        self.has_previous = self.page_number > 1
+        return results[:page_size]
+
+    def get_next_link(self):
+        if self.count_mode != COUNT_NONE:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.page_query_param, self.page_number + 1)
+
+    def get_previous_link(self):
+        if self.count_mode != COUNT_NONE:
+            return super().get_previous_link()
+        if not self.has_previous:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.page_number == 2:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.page_query_param, self.page_number - 1)
 
     def get_paginated_response(self, data):
+        if self.count_mode == COUNT_NONE:
+            return Response(
+                {
+                    "links": {
+                        "next": self.get_next_link(),
+                        "previous": self.get_previous_link(),
+                    },
+                    "has_next": self.has_next,
+                    "has_previous": self.has_previous,
+                    "current_page": self.page_number,
+                    "page_size": int(self.request.GET.get("page_size", self.page_size)),
+                    "results": data,
+                }
+            )
+
         return Response(
             {
                 "links": {
@@ -19,6 +175,161 @@ class CustomPagination(PageNumberPagination):
                 "current_page": int(self.request.GET.get("page", DEFAULT_PAGE)),
                 "page_size": int(self.request.GET.get("page_size", self.page_size)),
                 "total": self.page.paginator.count,
+                "estimated": self.count_mode == COUNT_ESTIMATE,
+                "results": data,
+            }
+        )
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginates newest first on (created_at, id) with opaque `before` and
+    `after` cursors, so every page is one indexed range scan without COUNT
+    or OFFSET, however far back it is.
+    """
+
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    before_query_param = "before"
+    after_query_param = "after"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        if after:
+            created_at, pk = after
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+            ).order_by("created_at", "id")
+        else:
+            if before:
+                created_at, pk = before
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+                )
+            queryset = queryset.order_by("-created_at", "-id")
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+        if after:
+            results.reverse()
+
+        self.has_older = has_more if not after else True
+        self.has_newer = has_more if after else bool(before)
+        self.page = results
+        return results
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, obj):
+        position = f"{obj.created_at.isoformat()}|{obj.id}"
+        return b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            created_at, pk = b64decode(cursor.encode()).decode().split("|")
+            created_at = parse_datetime(created_at)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def get_link(self, query_param, obj):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, query_param, self.encode_cursor(obj))
+
+    def get_next_link(self):
+        if not self.page or not self.has_older:
+            return None
+        return self.get_link(self.before_query_param, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.page or not self.has_newer:
+            return None
+        return self.get_link(self.after_query_param, self.page[0])
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "links": {
+                    "next": self.get_next_link(),
+                    "previous": self.get_previous_link(),
+                },
+                "cursors": {
+                    "before": (
+                        self.encode_cursor(self.page[-1])
+                        if self.page and self.has_older
+                        else None
+                    ),
+                    "after": self.encode_cursor(self.page[0]) if self.page else None,
+                },
+                "page_size": self.page_size,
+                "results": data,
+            }
+        )
+
+
+class SearchPagination(KeysetPagination):
+    """
+    Keyset pagination of search results, best match first on (rank, id),
+    with a `before` cursor to the next page.
+
+    Paginates a search function, called with the decoded cursor and a limit,
+    that returns results with `rank` and `id` attributes in that order.
+    """
+
+    page_size = 20
+    max_page_size = 50
+
+    def paginate_queryset(self, search, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+
+        results = list(search(before, self.page_size + 1))
+        self.has_older = len(results) > self.page_size
+        self.has_newer = False
+        self.page = results[: self.page_size]
+        return self.page
+
+    def encode_cursor(self, obj):
+        position = f"{obj.rank!r}|{obj.id}"
+        return b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            rank, pk = b64decode(cursor.encode()).decode().split("|")
+            return float(rank), str(uuid.UUID(pk))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_paginated_response(self, data):
+        next_cursor = (
+            self.encode_cursor(self.page[-1]) if self.page and self.has_older else None
+        )
+        return Response(
+            {
+                "links": {"next": self.get_next_link()},
+                "cursors": {"before": next_cursor},
+                "page_size": self.page_size,
                 "results": data,
             }
         )
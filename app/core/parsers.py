@@ -0,0 +1,18 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from core import fastjson
+
+
+class FastJSONParser(BaseParser):
+    """
+    Drop-in replacement for DRF's JSONParser backed by `core.fastjson`.
+    """
+
+    media_type = "application/json"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return fastjson.loads(stream.read())
+        except fastjson.DecodeError as exc:
+            raise ParseError("JSON parse error - %s" % str(exc))
@@ -0,0 +1,18 @@
+from rest_framework.renderers import BaseRenderer
+
+from core import fastjson
+
+
+class FastJSONRenderer(BaseRenderer):
+    """
+    Drop-in replacement for DRF's JSONRenderer backed by `core.fastjson`.
+    """
+
+    media_type = "application/json"
+    format = "json"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return fastjson.dumps(data)
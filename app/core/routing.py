@@ -1,6 +1,6 @@
 from django.urls import re_path
 
-from users.cosumers import ChatConsumer, UserConsumer
+from users.cosumers import ChatConsumer, MultiplexConsumer, UserConsumer
 
 websocket_urlpatterns = [
     re_path(
@@ -8,4 +8,5 @@ websocket_urlpatterns = [
         ChatConsumer.as_asgi(),
     ),
     re_path(r"ws/notifications/$", UserConsumer.as_asgi()),
+    re_path(r"ws/session/$", MultiplexConsumer.as_asgi()),
 ]
@@ -1,15 +1,82 @@
-import json
-
-from django.core.cache import cache
-from django.utils import timezone
+import uuid
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-from chats.models import ChatParticipant
+from chats import idempotency, membership, presence
+from chats.receipts import ReadReceiptBuffer
+from chats.typing import TypingIndicator
+from chats.serializers import SendMessageSerializer
+from core import fastjson
+
+
+@database_sync_to_async
+def create_message(user, chat_id, data):
+    """
+    Saves a message sent over a websocket, or finds the one a retry of the
+    same send already saved. Returns the message and None, or None and the
+    validation errors. The outbox dispatcher fans new messages out like the
+    ones sent over HTTP.
+    """
+    serializer = SendMessageSerializer(data=data)
+    if not serializer.is_valid():
+        return None, serializer.errors
+
+    message, _ = idempotency.save_message(serializer, chat_id=chat_id, sender=user)
+    return message, None
+
+
+class SendMessageMixin:
+    """
+    Handles `send_message` frames. Membership is checked again on every send,
+    since the user may have left the chat after the connection subscribed.
+    """
+
+    async def handle_send_message(self, chat_id, data):
+        client_message_id = data.get("client_message_id")
+        try:
+            if not await membership.ais_member(chat_id, self.user.id):
+                message, errors = None, "Not a member of this chat"
+            else:
+                message, errors = await create_message(
+                    self.user,
+                    chat_id,
+                    {
+                        **(data.get("message") or {}),
+                        "client_message_id": client_message_id,
+                    },
+                )
+        except Exception as e:
+            print(f"Error saving message: {e}")
+            message, errors = None, "Message could not be saved"
+
+        if errors:
+            await self.send(
+                text_data=fastjson.dumps_text(
+                    {
+                        "type": "error",
+                        "chat_id": chat_id,
+                        "client_message_id": client_message_id,
+                        "error": errors,
+                    }
+                )
+            )
+            return
+
+        await self.send(
+            text_data=fastjson.dumps_text(
+                {
+                    "type": "ack",
+                    "chat_id": chat_id,
+                    "client_message_id": client_message_id,
+                    "message_id": message.id,
+                    "created_at": message.created_at,
+                }
+            )
+        )
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(SendMessageMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
         self.chat_id = self.scope["url_route"]["kwargs"].get("chat_id")
@@ -24,6 +91,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
         self.room_group_name = "chat_%s" % self.chat_id
+        self.presence = presence.PresenceHeartbeat(self.user.id)
+        self.typing = TypingIndicator(self.channel_layer, self.user.id)
+        self.receipts = ReadReceiptBuffer(self.channel_layer, self.user.id)
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.heartbeat()
         await self.accept()
@@ -36,55 +106,52 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.channel_layer.group_discard(
                 self.room_group_name, self.channel_name
             )
-            cache.delete(self.user_cache_key)
+            await self.presence.inactive_in_chat(self.chat_id)
+            await self.typing.stop_all()
+            await self.receipts.close()
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
+        data = fastjson.loads(text_data)
         message = data.get("message")
         type = data.get("type")
 
         if type == "ping":
             await self.heartbeat()
-            await self.send(text_data=json.dumps({"type": "pong"}))
+            await self.send(text_data=fastjson.dumps_text({"type": "pong"}))
 
         elif type == "typing":
-            pass
+            await self.typing.typing(self.chat_id)
         elif type == "stop_typing":
-            pass
+            await self.typing.stop_typing(self.chat_id)
         elif type == "read_message":
-            pass
+            await self.receipts.read(self.chat_id, data.get("message_id"))
+        elif type == "send_message":
+            await self.handle_send_message(self.chat_id, data)
         elif type == "delete_message":
             pass
         elif type == "edit_message":
             pass
 
-    @database_sync_to_async
-    def heartbeat(self):
-        print("heartbeat")
-        self.user_cache_key = "%s:active_users:%s" % (
-            self.room_group_name,
-            self.user.id,
-        )
-        print("cache_key", self.user_cache_key)
-        cache.set(self.user_cache_key, self.user.id, 20)
-        print("set")
+    async def heartbeat(self):
+        await self.presence.active_in_chat(self.chat_id)
 
     async def chat_message(self, event):
+        # Messages from the dispatcher arrive already encoded.
+        if "frame" in event:
+            await self.send(text_data=event["frame"])
+            return
         message = event["message"]
-        await self.send(text_data=json.dumps({"message": message}))
+        await self.send(text_data=fastjson.dumps_text({"message": message}))
 
-    @database_sync_to_async
-    def handle_user_join_chat(self):
-        participant = ChatParticipant.objects.filter(
-            chat_id=self.chat_id, user=self.user
-        ).first()
+    async def typing_indicator(self, event):
+        if event["user_id"] != str(self.user.id):
+            await self.send(text_data=event["frame"])
 
-        print("participant", participant)
+    async def read_receipt(self, event):
+        await self.send(text_data=event["frame"])
 
-        if not participant:
-            return False
-
-        return True
+    async def handle_user_join_chat(self):
+        return await membership.ais_member(self.chat_id, self.user.id)
 
 
 class UserConsumer(AsyncWebsocketConsumer):
@@ -97,24 +164,152 @@ class UserConsumer(AsyncWebsocketConsumer):
 
         # Join user to channel_id
         self.room_group_name = "user_%s" % self.user.id
+        self.presence = presence.PresenceHeartbeat(self.user.id)
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.heartbeat()
         await self.accept()
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
+        data = fastjson.loads(text_data)
         message = data.get("message")
         if data.get("type") == "ping":
             await self.heartbeat()
-            await self.send(text_data=json.dumps({"type": "pong"}))
+            await self.send(text_data=fastjson.dumps_text({"type": "pong"}))
 
-    @database_sync_to_async
-    def heartbeat(self):
-        cache.set("last_seen_:%s" % self.user.id, timezone.now(), 30)
+    async def heartbeat(self):
+        await self.presence.online()
 
     async def notify_message(self, event):
+        if "frame" in event:
+            await self.send(text_data=event["frame"])
+            return
         message = event.get("message")
-        await self.send(text_data=json.dumps({"message": message}))
+        await self.send(text_data=fastjson.dumps_text({"message": message}))
+
+
+class MultiplexConsumer(SendMessageMixin, AsyncWebsocketConsumer):
+    """
+    One socket per user that carries notifications, presence and the
+    messages of every chat the client subscribes to, instead of one
+    ChatConsumer per open chat plus a UserConsumer.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.chat_ids = set()
+        self.room_group_name = "user_%s" % self.user.id
+        self.presence = presence.PresenceHeartbeat(self.user.id)
+        self.typing = TypingIndicator(self.channel_layer, self.user.id)
+        self.receipts = ReadReceiptBuffer(self.channel_layer, self.user.id)
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.heartbeat()
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if not self.user.is_authenticated:
+            return
+
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        for chat_id in list(self.chat_ids):
+            await self.unsubscribe(chat_id)
+        await self.receipts.close()
+
+    async def receive(self, text_data):
+        data = fastjson.loads(text_data)
+        type = data.get("type")
+        chat_id = self.parse_chat_id(data.get("chat_id"))
+
+        if type == "ping":
+            await self.heartbeat()
+            await self.send_json({"type": "pong"})
+
+        elif type == "subscribe":
+            if chat_id in self.chat_ids or await self.subscribe(chat_id):
+                await self.send_json({"type": "subscribed", "chat_id": chat_id})
+            else:
+                await self.send_json(
+                    {"type": "error", "chat_id": chat_id, "error": "Not a chat member"}
+                )
+
+        elif type == "unsubscribe":
+            if chat_id in self.chat_ids:
+                await self.unsubscribe(chat_id)
+            await self.send_json({"type": "unsubscribed", "chat_id": chat_id})
+
+        elif type == "typing" and chat_id in self.chat_ids:
+            await self.typing.typing(chat_id)
+
+        elif type == "stop_typing" and chat_id in self.chat_ids:
+            await self.typing.stop_typing(chat_id)
+
+        elif type == "send_message":
+            if chat_id in self.chat_ids:
+                await self.handle_send_message(chat_id, data)
+            else:
+                await self.send_json(
+                    {"type": "error", "chat_id": chat_id, "error": "Not subscribed"}
+                )
+
+        elif type == "read_message" and chat_id in self.chat_ids:
+            await self.receipts.read(chat_id, data.get("message_id"))
+
+        elif type == "presence":
+            online = await presence.aget_online_users(data.get("user_ids") or [])
+            await self.send_json({"type": "presence", "online": sorted(online)})
+
+    async def send_json(self, content):
+        await self.send(text_data=fastjson.dumps_text(content))
+
+    def parse_chat_id(self, chat_id):
+        # Group names must match the ones the dispatcher sends to.
+        try:
+            return str(uuid.UUID(str(chat_id)))
+        except ValueError:
+            return None
+
+    async def subscribe(self, chat_id):
+        if not chat_id or not await self.is_chat_member(chat_id):
+            return False
+
+        self.chat_ids.add(chat_id)
+        await self.channel_layer.group_add("chat_%s" % chat_id, self.channel_name)
+        await self.presence.active_in_chat(chat_id)
+        return True
+
+    async def unsubscribe(self, chat_id):
+        self.chat_ids.discard(chat_id)
+        await self.typing.stop_typing(chat_id)
+        await self.channel_layer.group_discard("chat_%s" % chat_id, self.channel_name)
+        await self.presence.inactive_in_chat(chat_id)
+
+    async def is_chat_member(self, chat_id):
+        return await membership.ais_member(chat_id, self.user.id)
+
+    async def heartbeat(self):
+        await self.presence.online()
+        for chat_id in self.chat_ids:
+            await self.presence.active_in_chat(chat_id)
+
+    async def chat_message(self, event):
+        if "frame" in event:
+            await self.send(text_data=event["frame"])
+            return
+        await self.send_json({"message": event["message"]})
+
+    async def notify_message(self, event):
+        await self.chat_message(event)
+
+    async def typing_indicator(self, event):
+        if event["user_id"] != str(self.user.id):
+            await self.send(text_data=event["frame"])
+
+    async def read_receipt(self, event):
+        await self.send(text_data=event["frame"])
@@ -0,0 +1,102 @@
+"""
+Cached profile cards (id, name, avatar url, phone number) of users, so
+serializers that render other users do not load them one query at a time.
+
+Cards are looked up in a small per-process LRU first, then in the Redis
+cache, then in the database. The LRU keeps entries for a few seconds only,
+since it cannot be invalidated from other processes. Redis entries are
+written under the user's current generation (see
+`core.cache.bump_generation`), so a card loaded before a profile edit
+committed is never served once the edit invalidated it.
+"""
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from core.cache import LocalCache, bump_generation, get_generations, versioned_key
+
+CACHE_KEY = "profile_card:%s"
+CACHE_TIMEOUT = 60 * 60
+LOCAL_CACHE_SIZE = 2048
+LOCAL_CACHE_TIMEOUT = 10
+
+local_cache = LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TIMEOUT)
+
+
+def build_profile_card(user):
+    return {
+        "id": str(user.id),
+        "name": user.name,
+        "profile_picture": user.profile_picture.url if user.profile_picture else None,
+        "phone_number": user.phone_number,
+    }
+
+
+def get_many(user_ids):
+    """
+    Returns a dict of user id (as a string) to profile card for the given
+    ids. Unknown users are left out.
+    """
+    user_ids = {str(user_id) for user_id in user_ids if user_id}
+    cards = {}
+
+    for user_id in user_ids:
+        card = local_cache.get(user_id)
+        if card is not None:
+            cards[user_id] = card
+
+    missing = user_ids - cards.keys()
+    keys = {}
+    if missing:
+        try:
+            generations = get_generations([CACHE_KEY % user_id for user_id in missing])
+            keys = {
+                user_id: versioned_key(
+                    CACHE_KEY % user_id, generations[CACHE_KEY % user_id]
+                )
+                for user_id in missing
+            }
+            cached = cache.get_many(list(keys.values()))
+        except Exception as e:
+            print(f"Error reading profile cards from cache: {e}")
+            keys, cached = {}, {}
+        for card in cached.values():
+            cards[card["id"]] = card
+            local_cache.set(card["id"], card)
+
+    missing = user_ids - cards.keys()
+    if missing:
+        loaded = {}
+        users = (
+            get_user_model()
+            .objects.filter(id__in=missing)
+            .only("id", "name", "profile_picture", "phone_number")
+        )
+        for user in users:
+            card = build_profile_card(user)
+            cards[card["id"]] = card
+            if card["id"] in keys:
+                loaded[keys[card["id"]]] = card
+            local_cache.set(card["id"], card)
+        try:
+            if loaded:
+                cache.set_many(loaded, CACHE_TIMEOUT)
+        except Exception as e:
+            print(f"Error writing profile cards to cache: {e}")
+
+    return cards
+
+
+def get(user_id):
+    """
+    Returns the profile card of a user, or None if the user does not exist.
+    """
+    return get_many([user_id]).get(str(user_id))
+
+
+def invalidate(user_id):
+    local_cache.delete(str(user_id))
+    try:
+        bump_generation(CACHE_KEY % user_id)
+    except Exception as e:
+        print(f"Error deleting profile card from cache: {e}")
@@ -3,11 +3,26 @@ from django.contrib.auth import get_user_model
 
 from rest_framework import serializers
 
+from users import profile_cards
 from users.utils import format_phone_number, verify_phone_number_format
 
 from .models import Otp, SavedContact
 
 
+class ProfileCardListSerializer(serializers.ListSerializer):
+    """
+    Loads the profile cards of every user a page refers to in one batch, so
+    the child serializer's per-object lookups are served from memory.
+
+    The child serializer lists those users in `get_profile_card_ids`.
+    """
+
+    def to_representation(self, data):
+        items = list(data.all() if hasattr(data, "all") else data)
+        profile_cards.get_many(self.child.get_profile_card_ids(items))
+        return super().to_representation(items)
+
+
 class SignUpSerializer(serializers.ModelSerializer):
     phone_number = serializers.CharField()
 
@@ -106,6 +121,10 @@ class SavedContactSerializer(serializers.ModelSerializer):
     class Meta:
         model = SavedContact
         fields = ["id", "contact", "contact_id", "user"]
+        list_serializer_class = ProfileCardListSerializer
+
+    def get_profile_card_ids(self, objs):
+        return [obj.contact_id for obj in objs]
 
     def validate_contact_id(self, contact):
         user = self.context["request"].user
@@ -118,8 +137,9 @@ class SavedContactSerializer(serializers.ModelSerializer):
         return contact
 
     def get_contact(self, obj):
+        card = profile_cards.get(obj.contact_id)
         return {
-            "id": obj.contact.id,
-            "name": obj.contact.name,
-            "phone_number": obj.contact.phone_number,
+            "id": card["id"],
+            "name": card["name"],
+            "phone_number": card["phone_number"],
         }
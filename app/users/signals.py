@@ -1,7 +1,11 @@
 from django.contrib.auth import get_user_model
-from django.db.models.signals import pre_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from . import profile_cards, user_cache
 from .utils import deleteImageInCloudinary
 
 
@@ -23,3 +27,34 @@ def handle_media_update(sender, instance, **kwargs):
 
     except Exception as e:
         print(f"Error in pre_save signal: {e}")
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def invalidate_profile_card(sender, instance, **kwargs):
+    """
+    Drops the cached profile card of a user once their change commits.
+    """
+    user_id = instance.pk
+    transaction.on_commit(lambda: profile_cards.invalidate(user_id))
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def invalidate_cached_user(sender, instance, **kwargs):
+    """
+    Drops the cached copy of a user used for authentication when they change,
+    including when they are deactivated. Waits for the commit, so a lookup
+    in the meantime cannot cache the row from before the change.
+    """
+    user_id = instance.pk
+    transaction.on_commit(lambda: user_cache.invalidate(user_id))
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def invalidate_cached_user_on_logout(sender, instance, created, **kwargs):
+    """
+    Drops the cached user when one of their refresh tokens is blacklisted.
+    """
+    if created and instance.token.user_id:
+        user_cache.invalidate(instance.token.user_id)
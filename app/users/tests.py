@@ -1,3 +1,420 @@
-from django.test import TestCase
+import asyncio
+import json
+import pickle
 
-# Create your tests here.
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from chats.models import Chat, Message, MessageOutbox
+from core.middleware import get_user_from_jwt
+
+from . import profile_cards, user_cache
+from .cosumers import MultiplexConsumer
+from .models import SavedContact
+
+
+def create_user(index, **extra_fields):
+    return get_user_model().objects.create(
+        phone_number="+234800000%04d" % index, name="user %s" % index, **extra_fields
+    )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class PaginationCountModeTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        for index in range(1, 6):
+            SavedContact.objects.create(user=self.user, contact=create_user(index))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse("user:savedcontact-list")
+
+    def test_exact_count_is_the_default(self):
+        response = self.client.get(self.url, {"page_size": 2})
+
+        self.assertEqual(response.data["total"], 5)
+        self.assertEqual(response.data["pages"], 3)
+        self.assertFalse(response.data["estimated"])
+
+    def test_count_none_skips_count_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                self.url, {"page_size": 2, "page": 3, "count": "none"}
+            )
+
+        self.assertNotIn("total", response.data)
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertFalse(response.data["has_next"])
+        self.assertTrue(response.data["has_previous"])
+        self.assertFalse(
+            any("COUNT(" in query["sql"].upper() for query in queries.captured_queries)
+        )
+
+    def test_count_none_has_next(self):
+        response = self.client.get(self.url, {"page_size": 2, "count": "none"})
+
+        self.assertTrue(response.data["has_next"])
+        self.assertIn("page=2", response.data["links"]["next"])
+
+    def test_estimated_count_is_cached(self):
+        self.client.get(self.url, {"page_size": 2, "count": "estimate"})
+        SavedContact.objects.create(user=self.user, contact=create_user(6))
+
+        response = self.client.get(self.url, {"page_size": 2, "count": "estimate"})
+
+        self.assertTrue(response.data["estimated"])
+        self.assertEqual(response.data["total"], 5)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class ProfileCardTests(TestCase):
+    def setUp(self):
+        self.users = [create_user(index) for index in range(3)]
+        self.user_ids = [user.id for user in self.users]
+
+    def test_get_many_queries_database_once(self):
+        with self.assertNumQueries(1):
+            cards = profile_cards.get_many(self.user_ids)
+        with self.assertNumQueries(0):
+            profile_cards.get_many(self.user_ids)
+
+        self.assertEqual(cards[str(self.users[0].id)]["name"], "user 0")
+
+    def test_redis_tier_is_used_when_local_cache_misses(self):
+        profile_cards.get_many(self.user_ids)
+        profile_cards.local_cache.clear()
+
+        with self.assertNumQueries(0):
+            cards = profile_cards.get_many(self.user_ids)
+        self.assertEqual(len(cards), 3)
+
+    def test_card_is_invalidated_when_user_is_saved(self):
+        profile_cards.get(self.users[0].id)
+
+        self.users[0].name = "renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users[0].save()
+
+        self.assertEqual(profile_cards.get(self.users[0].id)["name"], "renamed")
+
+    def test_load_racing_an_invalidation_is_not_cached(self):
+        user = self.users[0]
+        get_user_model().objects.filter(id=user.id).update(name="renamed")
+
+        # The edit commits, and invalidates the card, while the old name is
+        # being loaded.
+        def build_profile_card(loaded_user):
+            card = {**real_build_profile_card(loaded_user), "name": "user 0"}
+            profile_cards.invalidate(user.id)
+            return card
+
+        real_build_profile_card = profile_cards.build_profile_card
+        with mock.patch(
+            "users.profile_cards.build_profile_card", side_effect=build_profile_card
+        ):
+            self.assertEqual(profile_cards.get(user.id)["name"], "user 0")
+
+        profile_cards.local_cache.clear()
+        self.assertEqual(profile_cards.get(user.id)["name"], "renamed")
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@mock.patch("chats.presence.amark_inactive_in_chat")
+@mock.patch("chats.presence._atouch")
+class MultiplexConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.chat, _ = Chat.get_or_create_direct(self.user, create_user(1))
+        self.other_chat, _ = Chat.get_or_create_direct(create_user(2), create_user(3))
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(MultiplexConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_typing_is_relayed_to_the_other_members_only(self, *mocks):
+        async_to_sync(self.check_typing)()
+
+    async def check_typing(self):
+        communicator = await self.connect()
+        other_member = WebsocketCommunicator(MultiplexConsumer.as_asgi(), "/ws/")
+        other_member.scope["user"] = await get_user_model().objects.aget(
+            phone_number="+2348000000001"
+        )
+        await other_member.connect()
+
+        for member in (communicator, other_member):
+            await member.send_json_to(
+                {"type": "subscribe", "chat_id": str(self.chat.id)}
+            )
+            await member.receive_json_from()
+
+        await communicator.send_json_to(
+            {"type": "typing", "chat_id": str(self.chat.id)}
+        )
+        frame = await other_member.receive_json_from()
+        self.assertEqual(frame["type"], "typing")
+        self.assertEqual(frame["user_id"], str(self.user.id))
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+        self.assertEqual(
+            (await other_member.receive_json_from())["type"], "stop_typing"
+        )
+        await other_member.disconnect()
+
+    def test_sends_messages_to_subscribed_chats(self, *mocks):
+        async_to_sync(self.check_send_message)()
+
+    async def check_send_message(self):
+        communicator = await self.connect()
+        await communicator.send_json_to(
+            {"type": "subscribe", "chat_id": str(self.chat.id)}
+        )
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to(
+            {
+                "type": "send_message",
+                "chat_id": str(self.chat.id),
+                "client_message_id": "local-1",
+                "message": {"text": "hi"},
+            }
+        )
+        ack = await communicator.receive_json_from()
+        self.assertEqual(ack["type"], "ack")
+        self.assertEqual(ack["client_message_id"], "local-1")
+        message = await Message.objects.aget(id=ack["message_id"])
+        self.assertEqual(message.sender_id, self.user.id)
+        self.assertTrue(await MessageOutbox.objects.filter(message=message).aexists())
+
+        await communicator.send_json_to(
+            {
+                "type": "send_message",
+                "chat_id": str(self.chat.id),
+                "client_message_id": "local-1",
+                "message": {"text": "hi"},
+            }
+        )
+        retry_ack = await communicator.receive_json_from()
+        self.assertEqual(retry_ack["message_id"], ack["message_id"])
+
+        await communicator.send_json_to(
+            {
+                "type": "send_message",
+                "chat_id": str(self.chat.id),
+                "message": {"text": "hi", "type": "Video"},
+            }
+        )
+        self.assertIn("type", (await communicator.receive_json_from())["error"])
+
+        await communicator.send_json_to(
+            {
+                "type": "send_message",
+                "chat_id": str(self.other_chat.id),
+                "message": {"text": "hi"},
+            }
+        )
+        self.assertEqual((await communicator.receive_json_from())["type"], "error")
+        self.assertEqual(await Message.objects.acount(), 1)
+        await communicator.disconnect()
+
+    def test_cannot_send_after_leaving_the_chat(self, *mocks):
+        async_to_sync(self.check_send_after_leaving)()
+
+    async def check_send_after_leaving(self):
+        communicator = await self.connect()
+        await communicator.send_json_to(
+            {"type": "subscribe", "chat_id": str(self.chat.id)}
+        )
+        await communicator.receive_json_from()
+
+        participant = await self.chat.members.aget(user=self.user)
+        participant.left_at = timezone.now()
+        await participant.asave()
+
+        await communicator.send_json_to(
+            {
+                "type": "send_message",
+                "chat_id": str(self.chat.id),
+                "client_message_id": "local-1",
+                "message": {"text": "hi"},
+            }
+        )
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "error")
+        self.assertEqual(frame["client_message_id"], "local-1")
+        self.assertFalse(await Message.objects.aexists())
+        await communicator.disconnect()
+
+    def test_receives_messages_of_subscribed_chats_only(self, *mocks):
+        async_to_sync(self.check_subscriptions)()
+
+    async def check_subscriptions(self):
+        communicator = await self.connect()
+        channel_layer = get_channel_layer()
+
+        await communicator.send_json_to(
+            {"type": "subscribe", "chat_id": str(self.chat.id)}
+        )
+        self.assertEqual((await communicator.receive_json_from())["type"], "subscribed")
+        await communicator.send_json_to(
+            {"type": "subscribe", "chat_id": str(self.other_chat.id)}
+        )
+        self.assertEqual((await communicator.receive_json_from())["type"], "error")
+
+        frame = json.dumps({"message": {"text": "hi"}})
+        await channel_layer.group_send(
+            "chat_%s" % self.other_chat.id, {"type": "chat_message", "frame": frame}
+        )
+        await channel_layer.group_send(
+            "chat_%s" % self.chat.id, {"type": "chat_message", "frame": frame}
+        )
+        await channel_layer.group_send(
+            "user_%s" % self.user.id, {"type": "notify_message", "frame": frame}
+        )
+
+        self.assertEqual(await communicator.receive_from(), frame)
+        self.assertEqual(await communicator.receive_from(), frame)
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.send_json_to(
+            {"type": "unsubscribe", "chat_id": str(self.chat.id)}
+        )
+        await communicator.receive_json_from()
+        await channel_layer.group_send(
+            "chat_%s" % self.chat.id, {"type": "chat_message", "frame": frame}
+        )
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class UserCacheTests(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        user_cache.local_cache.clear()
+
+    def test_concurrent_lookups_share_one_load(self):
+        data = pickle.dumps(self.user)
+
+        async def lookup_many():
+            return await asyncio.gather(
+                *(user_cache.aget_user(self.user.id) for _ in range(10))
+            )
+
+        with mock.patch("users.user_cache._load", return_value=data) as load:
+            users = async_to_sync(lookup_many)()
+
+        load.assert_called_once_with(str(self.user.id))
+        self.assertEqual({user.id for user in users}, {self.user.id})
+        self.assertEqual(len({id(user) for user in users}), 10)
+
+    def test_cached_user_is_invalidated_on_save(self):
+        user_cache.get_user(self.user.id)
+
+        self.user.name = "renamed"
+        self.user.save()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(user_cache.get_user(self.user.id).name, "renamed")
+        with self.assertNumQueries(0):
+            user_cache.get_user(self.user.id)
+
+    def test_lookup_racing_an_invalidation_is_not_cached(self):
+        users = get_user_model().objects
+        filter = users.filter
+
+        def deactivate_during_load(*args, **kwargs):
+            # The deactivation commits after the lookup read the row.
+            user = filter(*args, **kwargs).first()
+            filter(id=self.user.id).update(is_active=False)
+            user_cache.invalidate(self.user.id)
+            return mock.Mock(first=mock.Mock(return_value=user))
+
+        with mock.patch.object(users, "filter", deactivate_during_load):
+            self.assertTrue(user_cache.get_user(self.user.id).is_active)
+
+        user_cache.local_cache.clear()
+        self.assertFalse(user_cache.get_user(self.user.id).is_active)
+
+    def test_deactivated_user_cannot_connect(self):
+        token = str(AccessToken.for_user(self.user))
+        self.assertEqual(async_to_sync(get_user_from_jwt)(token), self.user)
+
+        self.user.is_active = False
+        self.user.save()
+
+        user = async_to_sync(get_user_from_jwt)(token)
+        self.assertIsInstance(user, AnonymousUser)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.refresh = RefreshToken.for_user(self.user)
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer %s" % self.refresh.access_token
+        )
+        user_cache.local_cache.clear()
+
+    def get_user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("chats:chat-list"))
+        self.assertEqual(response.status_code, 200)
+        return [
+            query
+            for query in queries.captured_queries
+            if 'FROM "users_customuser"' in query["sql"]
+        ]
+
+    def test_user_is_loaded_once(self):
+        self.assertEqual(len(self.get_user_queries()), 1)
+        self.assertEqual(len(self.get_user_queries()), 0)
+
+    def test_deactivated_user_is_rejected(self):
+        self.get_user_queries()
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+
+        response = self.client.get(reverse("chats:chat-list"))
+        self.assertEqual(response.status_code, 401)
+
+    def test_logout_drops_cached_user(self):
+        self.get_user_queries()
+        self.assertIsNotNone(user_cache.local_cache.get(str(self.user.id)))
+
+        self.client.post(
+            reverse("user:logout"), {"refresh_token": str(self.refresh)}, format="json"
+        )
+
+        self.assertIsNone(user_cache.local_cache.get(str(self.user.id)))
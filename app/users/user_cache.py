@@ -0,0 +1,95 @@
+"""
+Short lived cache of authenticated users, so resolving the user of a JWT
+does not query the database on every request or websocket handshake.
+
+Users are kept pickled in a per-process LRU for a few seconds and in the
+Redis cache for a minute, and are dropped from both once a save or delete
+of the user commits. Redis entries are written under the user's current
+generation (see `core.cache.bump_generation`), so a lookup that loaded the
+user before a deactivation cannot cache the stale row. Every lookup
+returns a fresh copy, so a request can modify its user without affecting
+others.
+"""
+
+import asyncio
+import pickle
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from channels.db import database_sync_to_async
+
+from core.cache import LocalCache, bump_generation, get_generations, versioned_key
+
+CACHE_KEY = "auth_user:%s"
+CACHE_TIMEOUT = 60
+LOCAL_CACHE_SIZE = 4096
+LOCAL_CACHE_TIMEOUT = 5
+
+local_cache = LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TIMEOUT)
+
+# Lookups in progress on the event loop, keyed by user id, so concurrent
+# handshakes of the same user share one load.
+_pending_loads = {}
+
+
+def _load(user_id):
+    data = local_cache.get(user_id)
+    key = None
+    if data is None:
+        try:
+            generation = get_generations([CACHE_KEY % user_id])[CACHE_KEY % user_id]
+            key = versioned_key(CACHE_KEY % user_id, generation)
+            data = cache.get(key)
+        except Exception as e:
+            print(f"Error reading user from cache: {e}")
+            data = None
+
+    if data is None:
+        user = get_user_model().objects.filter(id=user_id).first()
+        if user is None:
+            return None
+        data = pickle.dumps(user)
+        if key:
+            try:
+                cache.set(key, data, CACHE_TIMEOUT)
+            except Exception as e:
+                print(f"Error writing user to cache: {e}")
+
+    local_cache.set(user_id, data)
+    return data
+
+
+def get_user(user_id):
+    """
+    Returns the user with the given id, or None if there is no such user.
+    """
+    data = _load(str(user_id))
+    return pickle.loads(data) if data else None
+
+
+async def aget_user(user_id):
+    """
+    Async version of `get_user`. Concurrent calls for the same user wait on
+    a single cache or database lookup.
+    """
+    user_id = str(user_id)
+    data = local_cache.get(user_id)
+
+    if data is None:
+        load = _pending_loads.get(user_id)
+        if load is None:
+            load = asyncio.ensure_future(database_sync_to_async(_load)(user_id))
+            _pending_loads[user_id] = load
+            load.add_done_callback(lambda _: _pending_loads.pop(user_id, None))
+        data = await asyncio.shield(load)
+
+    return pickle.loads(data) if data else None
+
+
+def invalidate(user_id):
+    local_cache.delete(str(user_id))
+    try:
+        bump_generation(CACHE_KEY % user_id)
+    except Exception as e:
+        print(f"Error deleting user from cache: {e}")